@@ -0,0 +1,35 @@
+from pymongo.errors import BulkWriteError
+
+
+def insert(document):
+    return 'insert', document
+
+
+def update_one(query, update, upsert=False):
+    return 'update_one', query, update, upsert
+
+
+def update_many(query, update, upsert=False):
+    return 'update', query, update, upsert
+
+
+# Write errors other than duplicate keys are raised, duplicates are returned in 'writeErrors' when the caller
+# expects them, e.g. to skip documents inserted by a concurrent request
+def bulk_write(collection, operations, ordered=False, ignore_duplicates=False):
+    if not operations:
+        return {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'writeErrors': []}
+    bulk = collection.initialize_ordered_bulk_op() if ordered else collection.initialize_unordered_bulk_op()
+    for operation in operations:
+        if operation[0] == 'insert':
+            bulk.insert(operation[1])
+        else:
+            kind, query, update, upsert = operation
+            selected = bulk.find(query).upsert() if upsert else bulk.find(query)
+            getattr(selected, kind)(update)
+    try:
+        return bulk.execute()
+    except BulkWriteError as e:
+        duplicates_only = all(error['code'] == 11000 for error in e.details['writeErrors'])
+        if not ignore_duplicates or not duplicates_only or e.details.get('writeConcernErrors'):
+            raise
+        return e.details
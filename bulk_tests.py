@@ -0,0 +1,65 @@
+import unittest
+from unittest.mock import MagicMock
+
+import mongomock
+from pymongo.errors import BulkWriteError
+
+from bulk import bulk_write, insert, update_one, update_many
+from mongomock_compat import install_mongomock_bulk_api
+
+
+install_mongomock_bulk_api()
+
+
+class BulkWriteTest(unittest.TestCase):
+    def test_should_send_all_operations_in_one_unordered_bulk(self):
+        collection = MagicMock()
+        bulk = collection.initialize_unordered_bulk_op.return_value
+
+        bulk_write(collection, [insert({"a": 1}), update_one({"b": 1}, {"$set": {"c": 1}}, upsert=True),
+                                update_many({"d": 1}, {"$set": {"e": 1}})])
+
+        bulk.insert.assert_called_once_with({"a": 1})
+        bulk.find.return_value.upsert.return_value.update_one.assert_called_once_with({"$set": {"c": 1}})
+        bulk.find.return_value.update.assert_called_once_with({"$set": {"e": 1}})
+        bulk.execute.assert_called_once_with()
+
+    def test_should_apply_operations(self):
+        collection = mongomock.Connection().db.collection
+        collection.insert({"b": 1})
+
+        result = bulk_write(collection, [insert({"a": 1}), update_one({"b": 1}, {"$set": {"c": 1}}),
+                                         update_one({"b": 2}, {"$set": {"c": 2}}, upsert=True)])
+
+        self.assertEqual(1, result['nInserted'])
+        self.assertEqual(1, result['nMatched'])
+        self.assertEqual(1, result['nUpserted'])
+        self.assertEqual(3, collection.count())
+
+    def test_should_raise_duplicates_unless_caller_ignores_them(self):
+        collection = mongomock.Connection().db.collection
+        collection.insert({"_id": 1})
+
+        self.assertRaises(BulkWriteError, bulk_write, collection, [insert({"_id": 1})])
+        result = bulk_write(collection, [insert({"_id": 1}), insert({"_id": 2})], ignore_duplicates=True)
+
+        self.assertEqual(1, result['nInserted'])
+        self.assertEqual([1], [error['op']['_id'] for error in result['writeErrors']])
+
+    def test_should_raise_other_write_errors(self):
+        collection = MagicMock()
+        collection.initialize_unordered_bulk_op.return_value.execute.side_effect = BulkWriteError(
+            {'writeErrors': [{'index': 0, 'code': 11000}, {'index': 1, 'code': 121}]})
+
+        self.assertRaises(BulkWriteError, bulk_write, collection, [insert({}), insert({})], ignore_duplicates=True)
+
+    def test_should_skip_empty_bulk(self):
+        collection = MagicMock()
+
+        bulk_write(collection, [])
+
+        self.assertFalse(collection.initialize_unordered_bulk_op.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
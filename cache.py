@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Bounded least-recently-used cache whose entries expire after `ttl` seconds. With a `version` callable the
+# whole cache is dropped once it returns another value, it is checked at most every `check_interval` seconds.
+class TTLCache():
+    def __init__(self, max_size, ttl, version=None, check_interval=0.0, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = version
+        self.check_interval = check_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._version = None
+        self._checked_at = None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock() + self.ttl, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _check_version(self):
+        if self.version is None:
+            return
+        now = self.clock()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        version = self.version()
+        with self._lock:
+            self._checked_at = now
+            if version != self._version:
+                self._version = version
+                self._generation += 1
+                self._entries.clear()
+
+    def get_or_load(self, key, loader):
+        self._check_version()
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        generation = self._generation
+        value = loader()
+        with self._lock:
+            # do not cache a value loaded before a concurrent invalidation
+            if generation == self._generation:
+                self._put(key, value)
+        return value
+
+    def get_or_load_many(self, keys, loader):
+        self._check_version()
+        missing = object()
+        values = {key: self.get(key, missing) for key in keys}
+        not_cached = [key for key, value in values.items() if value is missing]
+        if not_cached:
+            generation = self._generation
+            loaded = loader(not_cached)
+            with self._lock:
+                for key in not_cached:
+                    values[key] = loaded.get(key)
+                    if generation == self._generation:
+                        self._put(key, values[key])
+        return values
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._checked_at = None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Read-mostly copy of a small collection kept whole in memory and indexed by each of `keys`. It is reloaded once
+# `version()` returns another value, the version is checked at most every `check_interval` seconds.
+class IndexedSnapshot():
+    def __init__(self, load, version, keys, check_interval=5.0, clock=time.time):
+        self.load = load
+        self.version = version
+        self.keys = keys
+        self.check_interval = check_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._indexes = None
+        self._version = None
+        self._checked_at = None
+
+    def get(self, key, value):
+        return self._current()[key].get(value)
+
+    def values(self):
+        return list(self._current()[self.keys[0]].values())
+
+    def _current(self):
+        indexes, checked_at = self._indexes, self._checked_at
+        if indexes is not None and self.clock() - checked_at < self.check_interval:
+            return indexes
+        with self._lock:
+            if self._indexes is None or self.clock() - self._checked_at >= self.check_interval:
+                # the version is read first, data changed after it is reloaded on the next check
+                version = self.version()
+                if self._indexes is None or version != self._version:
+                    documents = self.load()
+                    self._indexes = {key: {document[key]: document for document in documents} for key in self.keys}
+                    self._version = version
+                self._checked_at = self.clock()
+            return self._indexes
+
+    def clear(self):
+        with self._lock:
+            self._indexes = None
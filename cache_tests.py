@@ -0,0 +1,124 @@
+import unittest
+
+from cache import TTLCache, IndexedSnapshot
+
+
+class Clock():
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_should_load_value_once(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        loads = []
+
+        cache.get_or_load("tag", lambda: loads.append(1) or "user")
+        value = cache.get_or_load("tag", lambda: loads.append(1) or "user")
+
+        self.assertEqual("user", value)
+        self.assertEqual(1, len(loads))
+
+    def test_should_cache_none(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.get_or_load("tag", lambda: None)
+
+        self.assertIsNone(cache.get_or_load("tag", lambda: self.fail("should be cached")))
+
+    def test_should_expire_entries_after_ttl(self):
+        clock = Clock()
+        cache = TTLCache(max_size=10, ttl=60, clock=clock)
+        cache.put("tag", "user")
+
+        clock.now += 61
+
+        self.assertEqual("missing", cache.get("tag", "missing"))
+
+    def test_should_evict_least_recently_used_entry(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.put("first", 1)
+        cache.put("second", 2)
+        cache.get("first")
+
+        cache.put("third", 3)
+
+        self.assertEqual(1, cache.get("first"))
+        self.assertIsNone(cache.get("second"))
+        self.assertEqual(2, len(cache))
+
+    def test_should_load_only_missing_keys_at_once(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.put("first", "cached")
+        loads = []
+
+        def loader(keys):
+            loads.append(sorted(keys))
+            return {"second": "loaded"}
+
+        values = cache.get_or_load_many(["first", "second", "third"], loader)
+
+        self.assertEqual({"first": "cached", "second": "loaded", "third": None}, values)
+        self.assertEqual([["second", "third"]], loads)
+        self.assertIsNone(cache.get_or_load("third", lambda: self.fail("should be cached")))
+
+    def test_should_not_cache_value_loaded_during_invalidation(self):
+        cache = TTLCache(max_size=10, ttl=60)
+
+        cache.get_or_load("tag", lambda: cache.invalidate("tag") or "stale owner")
+
+        self.assertIsNone(cache.get("tag"))
+
+    def test_should_drop_entries_when_version_changes(self):
+        version = [1]
+        cache = TTLCache(max_size=10, ttl=60, version=lambda: version[0])
+        cache.get_or_load("tag", lambda: "old owner")
+
+        version[0] = 2
+
+        self.assertEqual("new owner", cache.get_or_load("tag", lambda: "new owner"))
+        self.assertEqual({"tag": "new owner"}, cache.get_or_load_many(["tag"], lambda keys: self.fail("cached")))
+
+
+class IndexedSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.version = 1
+        self.loads = 0
+        self.snapshot = IndexedSnapshot(self.load, lambda: self.version, keys=("workshopId", "emailSecret"),
+                                        check_interval=5, clock=self.clock)
+
+    def load(self):
+        self.loads += 1
+        return [{"workshopId": "w1", "emailSecret": "s1", "name": "Workshop %d" % self.version}]
+
+    def test_should_index_documents_by_every_key(self):
+        self.assertEqual("w1", self.snapshot.get("emailSecret", "s1")['workshopId'])
+        self.assertEqual("s1", self.snapshot.get("workshopId", "w1")['emailSecret'])
+        self.assertIsNone(self.snapshot.get("workshopId", "w2"))
+        self.assertEqual(1, self.loads)
+
+    def test_should_reload_once_version_changes(self):
+        self.snapshot.get("workshopId", "w1")
+        self.version = 2
+
+        self.assertEqual("Workshop 1", self.snapshot.get("workshopId", "w1")['name'])
+        self.clock.now += 5
+        self.assertEqual("Workshop 2", self.snapshot.get("workshopId", "w1")['name'])
+        self.clock.now += 5
+        self.snapshot.get("workshopId", "w1")
+        self.assertEqual(2, self.loads)
+
+    def test_should_reload_after_clear(self):
+        self.snapshot.get("workshopId", "w1")
+
+        self.snapshot.clear()
+
+        self.assertEqual(1, len(self.snapshot.values()))
+        self.assertEqual(2, self.loads)
+
+
+if __name__ == '__main__':
+    unittest.main()
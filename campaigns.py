@@ -0,0 +1,154 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+import uuid
+
+from emails import MailMessageCreator
+
+
+logger = logging.getLogger('campaigns')
+
+
+def create_campaign_query(regex):
+    query = {"isSecondConfirmationMailSent": {"$ne": True}}
+    if regex:
+        query.update({"email": {"$regex": regex}})
+    return query
+
+
+def campaign_status(campaign, now=None):
+    now = now or datetime.datetime.utcnow()
+    elapsed = ((campaign.get('finishedAt') or now) - campaign['startedAt']).total_seconds()
+    return {
+        "id": str(campaign['_id']),
+        "status": campaign['status'],
+        "query": campaign['regex'],
+        "count": campaign['count'],
+        "sent": campaign['sent'],
+        "failed": campaign['failed'],
+        "startedAt": campaign['startedAt'],
+        "updatedAt": campaign['updatedAt'],
+        "finishedAt": campaign.get('finishedAt'),
+        "emailsPerSecond": round(campaign['sent'] / elapsed, 2) if elapsed > 0 else None
+    }
+
+
+# Sends second confirmation emails in batches from background threads. Progress is checkpointed in the
+# `campaigns` collection after every batch, so a campaign interrupted by a crash continues from its last
+# checkpoint. A lease renewed with every batch keeps other processes from running the same campaign.
+class CampaignRunner():
+    def __init__(self, get_db, context, batch_size=100, lease_seconds=120, send_timeout=60):
+        self.get_db = get_db
+        self.context = context
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.send_timeout = send_timeout
+        self._owner = None
+        self._owner_pid = None
+        self._threads = []
+
+    @property
+    def owner(self):
+        # A forked worker process must not hold leases under the name of its parent
+        if self._owner_pid != os.getpid():
+            self._owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+            self._owner_pid = os.getpid()
+            self._threads = []
+        return self._owner
+
+    def start(self, regex, count):
+        now = datetime.datetime.utcnow()
+        campaign_id = self.get_db().campaigns.insert({
+            "kind": "second_confirmation",
+            "regex": regex,
+            "count": count,
+            "status": "running",
+            "checkpoint": None,
+            "sent": 0,
+            "failed": 0,
+            "startedAt": now,
+            "updatedAt": now,
+            "owner": None,
+            "leaseUntil": now
+        })
+        self._run_in_background(campaign_id)
+        return campaign_id
+
+    def resume(self):
+        expired = {"status": "running", "leaseUntil": {"$lt": datetime.datetime.utcnow()}}
+        campaigns = self.get_db().campaigns.find(expired, {"_id": 1})
+        campaign_ids = [campaign['_id'] for campaign in campaigns]
+        for campaign_id in campaign_ids:
+            logger.info("Resuming campaign %s", campaign_id)
+            self._run_in_background(campaign_id)
+        return campaign_ids
+
+    def wait(self, timeout=None):
+        for thread in list(self._threads):
+            thread.join(timeout)
+
+    def _run_in_background(self, campaign_id):
+        thread = threading.Thread(target=self._run, args=(campaign_id,), name='campaign-%s' % campaign_id)
+        thread.daemon = True
+        self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+        thread.start()
+
+    def _run(self, campaign_id):
+        with self.context():
+            try:
+                campaign = self._claim(campaign_id)
+                while campaign is not None and campaign['status'] == "running":
+                    campaign = self._send_batch(campaign)
+            except Exception:
+                logger.exception("Campaign %s stopped, it will be resumed from the last checkpoint", campaign_id)
+
+    def _claim(self, campaign_id):
+        now = datetime.datetime.utcnow()
+        return self.get_db().campaigns.find_and_modify(
+            query={"_id": campaign_id, "status": "running",
+                   "$or": [{"leaseUntil": {"$lt": now}}, {"owner": self.owner}]},
+            update={"$set": {"owner": self.owner,
+                             "leaseUntil": now + datetime.timedelta(seconds=self.lease_seconds)}},
+            new=True
+        )
+
+    def _send_batch(self, campaign):
+        query = create_campaign_query(campaign['regex'])
+        if campaign['checkpoint'] is not None:
+            query["_id"] = {"$gt": campaign['checkpoint']}
+        batch_size = self.batch_size
+        if campaign['count']:
+            batch_size = min(batch_size, campaign['count'] - campaign['sent'] - campaign['failed'])
+        users = list(self.get_db().users.find(query, {"email": 1, "name": 1, "key": 1})
+                     .sort([("_id", 1)]).limit(batch_size)) if batch_size > 0 else []
+
+        deliveries = []
+        for user in users:
+            message = MailMessageCreator.second_confirmation_email(user['email'], user['name'], user['key'])
+            deliveries.append((user['email'], message.send(to=user['email'])))
+        sent = [email for email, delivery in deliveries if self._delivered(delivery)]
+        if sent:
+            self.get_db().users.update({"email": {"$in": sent}}, {"$set": {"isSecondConfirmationMailSent": True}},
+                                       multi=True)
+
+        now = datetime.datetime.utcnow()
+        update = {"$inc": {"sent": len(sent), "failed": len(deliveries) - len(sent)},
+                  "$set": {"updatedAt": now, "leaseUntil": now + datetime.timedelta(seconds=self.lease_seconds)}}
+        if users:
+            update["$set"]["checkpoint"] = users[-1]['_id']
+        else:
+            update["$set"].update(status="done", finishedAt=now)
+        return self.get_db().campaigns.find_and_modify(
+            query={"_id": campaign['_id'], "owner": self.owner},
+            update=update,
+            new=True
+        )
+
+    def _delivered(self, delivery):
+        try:
+            # a message stored in the outbox resolves to its id, outbox workers take care of delivering it
+            return getattr(delivery.result(timeout=self.send_timeout), 'status_code', 200) == 200
+        except Exception:
+            return False
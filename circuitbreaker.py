@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import deque
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__("Circuit %s is open, retry in %.1f seconds" % (name, retry_after))
+        self.name = name
+        self.retry_after = retry_after
+
+
+# Keeps the outcome of the last `window` calls. Once at least `min_calls` were made and the share of failed ones
+# reaches `failure_rate` the circuit opens and calls fail fast with CircuitOpenError for `open_seconds`. After that
+# a single probe call is let through, its outcome closes the circuit or opens it again.
+class CircuitBreaker():
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window=20, open_seconds=30, on_change=None,
+                 clock=time.time):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.on_change = on_change
+        self.clock = clock
+        self.trips = 0
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def before_call(self):
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            retry_after = max(1.0, self._opened_at + self.open_seconds - self.clock())
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, success):
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                self._probing = False
+                if success:
+                    self._set_state(CLOSED)
+                else:
+                    self._trip()
+            elif state == CLOSED:
+                self._outcomes.append(success)
+                calls = len(self._outcomes)
+                if calls >= self.min_calls and self._outcomes.count(False) >= self.failure_rate * calls:
+                    self._trip()
+
+    def reset(self):
+        with self._lock:
+            self._outcomes.clear()
+            self._probing = False
+            if self._state != CLOSED:
+                self._set_state(CLOSED)
+
+    def _current_state(self):
+        if self._state == OPEN and self.clock() - self._opened_at >= self.open_seconds:
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    def _trip(self):
+        self.trips += 1
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+        self._set_state(OPEN)
+
+    def _set_state(self, state):
+        self._state = state
+        if self.on_change is not None:
+            self.on_change(self, state)
+
+
+# Read timeout following the latency of recent calls: `multiplier` times their 99th percentile, kept between
+# `minimum` and `maximum`. The maximum is used until `min_samples` calls were observed.
+class AdaptiveTimeout():
+    def __init__(self, minimum, maximum, multiplier=3.0, samples=200, min_samples=20):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=samples)
+
+    def observe(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def current(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.maximum
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return min(self.maximum, max(self.minimum, p99 * self.multiplier))
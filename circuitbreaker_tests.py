@@ -0,0 +1,82 @@
+import unittest
+
+from circuitbreaker import CircuitBreaker, CircuitOpenError, AdaptiveTimeout, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock():
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.changes = []
+        self.breaker = CircuitBreaker('mailgun', failure_rate=0.5, min_calls=4, window=10, open_seconds=30,
+                                      on_change=lambda breaker, state: self.changes.append(state), clock=self.clock)
+
+    def test_should_open_when_failure_rate_is_reached(self):
+        # Given
+        for success in [True, False, True]:
+            self.breaker.record(success)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+        # When
+        self.breaker.record(False)
+
+        # Then
+        self.assertEqual((OPEN, 1), (self.breaker.state, self.breaker.trips))
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.before_call()
+        self.assertEqual(30, raised.exception.retry_after)
+
+    def test_should_let_one_probe_through_after_open_period(self):
+        # Given
+        for _ in range(4):
+            self.breaker.record(False)
+
+        # When
+        self.clock.now += 30
+
+        # Then
+        self.breaker.before_call()
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+        self.breaker.record(True)
+        self.assertEqual([OPEN, HALF_OPEN, CLOSED], self.changes)
+
+    def test_should_open_again_when_probe_fails(self):
+        for _ in range(4):
+            self.breaker.record(False)
+        self.clock.now += 30
+        self.breaker.before_call()
+
+        self.breaker.record(False)
+
+        self.assertEqual((OPEN, 2), (self.breaker.state, self.breaker.trips))
+
+
+class AdaptiveTimeoutTest(unittest.TestCase):
+    def test_should_use_maximum_until_enough_latencies_are_observed(self):
+        timeout = AdaptiveTimeout(minimum=1, maximum=10, multiplier=3, min_samples=2)
+        timeout.observe(0.5)
+
+        self.assertEqual(10, timeout.current())
+
+    def test_should_follow_recent_latency_within_bounds(self):
+        timeout = AdaptiveTimeout(minimum=1, maximum=10, multiplier=3, samples=4, min_samples=2)
+
+        for latency in [0.1, 0.2, 1.0, 2.0]:
+            timeout.observe(latency)
+        self.assertEqual(6, timeout.current())
+
+        for latency in [0.1, 0.1, 0.1, 0.1]:
+            timeout.observe(latency)
+        self.assertEqual(1, timeout.current())
+
+
+if __name__ == '__main__':
+    unittest.main()
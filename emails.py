@@ -7,13 +7,16 @@ from urllib.parse import quote_plus as escape_uri
 import yaml
 
 import mailgunresource
+import mailqueue
+from circuitbreaker import CircuitOpenError
 
 WARSJAVA_SENDER_EMAIL = 'Warsjawa <contact@warsjawa.pl>'
 
 
 def read_templates():
     f = open("emails.yml", encoding="utf-8")
-    return yaml.load(f)
+    return {name: {part: string.Template(text) for part, text in parts.items()}
+            for name, parts in yaml.load(f).items()}
 
 
 templates = read_templates()
@@ -24,7 +27,14 @@ def generate_email_id():
 
 
 def substitute_variables(template, data):
-    return string.Template(template).safe_substitute(**data)
+    if not isinstance(template, string.Template):
+        template = string.Template(template)
+    return template.safe_substitute(**data)
+
+
+def render_template(template_name, data):
+    # templates are parsed once when loaded, rendered output is not kept as it holds user keys and message bodies
+    return {part: substitute_variables(template, data) for part, template in templates[template_name].items()}
 
 
 def create_email_address_for_workshop(email_secret):
@@ -34,88 +44,150 @@ def create_email_address_for_workshop(email_secret):
 class MailMessageCreator():
     @classmethod
     def user_registration(cls, user_name, user_key, user_email):
-        template = templates["user_registration"]
         data = {
             'name': user_name,
             'userCode': user_key,
             'userEmail': escape_uri(user_email)
         }
+        rendered = render_template("user_registration", data)
         return EmailMessage(
             sender=WARSJAVA_SENDER_EMAIL,
-            subject=substitute_variables(template['subject'], data),
-            text=substitute_variables(template['body-plain'], data),
-            html=substitute_variables(template['body-html'], data),
-            date=datetime.datetime.now()
+            subject=rendered['subject'],
+            text=rendered['body-plain'],
+            html=rendered['body-html'],
+            date=datetime.datetime.now(),
+            priority=mailqueue.TRANSACTIONAL
         )
 
     @classmethod
     def user_confirmation(cls, user_name, user_key, user_email):
-        template = templates["user_confirmation"]
         data = {
             'name': user_name,
             'userCode': user_key,
             'userEmail': escape_uri(user_email)
         }
+        rendered = render_template("user_confirmation", data)
         return EmailMessage(
             sender=WARSJAVA_SENDER_EMAIL,
-            subject=substitute_variables(template['subject'], data),
-            text=substitute_variables(template['body-plain'], data),
-            html=substitute_variables(template['body-html'], data),
-            date=datetime.datetime.now()
+            subject=rendered['subject'],
+            text=rendered['body-plain'],
+            html=rendered['body-html'],
+            date=datetime.datetime.now(),
+            priority=mailqueue.TRANSACTIONAL
         )
 
     @classmethod
     def forward_workshop_message(cls, mentor_message, workshop):
-        template = templates["workshop_mail"]
         data = {
             'workshopName': workshop['name'] if 'name' in workshop else workshop['workshopId'],
             'originalSubject': mentor_message.subject,
             'plainEmailBody': mentor_message.text,
             'htmlEmailBody': mentor_message.html
         }
+        rendered = render_template("workshop_mail", data)
         return EmailMessage(
             sender=mentor_message.sender,
-            subject=substitute_variables(template['subject'], data),
-            text=substitute_variables(template['body-plain'], data),
-            html=(substitute_variables(template['body-html'], data) if data['htmlEmailBody'] is not None else None),
+            subject=rendered['subject'],
+            text=rendered['body-plain'],
+            html=(rendered['body-html'] if data['htmlEmailBody'] is not None else None),
             date=mentor_message.date
         )
 
     @classmethod
     def mentor_welcome_email(cls, workshop_name, email_secret):
-        template = templates["mentor_welcome"]
         data = {
             'workshopName': workshop_name,
             'workshopEmail': create_email_address_for_workshop(email_secret)
         }
+        rendered = render_template("mentor_welcome", data)
         return EmailMessage(
             sender=WARSJAVA_SENDER_EMAIL,
-            subject=substitute_variables(template['subject'], data),
-            text=substitute_variables(template['body-plain'], data),
-            html=substitute_variables(template['body-html'], data),
+            subject=rendered['subject'],
+            text=rendered['body-plain'],
+            html=rendered['body-html'],
             date=datetime.datetime.now()
         )
 
     @classmethod
     def second_confirmation_email(cls, user_email, user_name, user_code):
-        template = templates["second_confirmation"]
         data = {
             'userEmail': user_email,
             'userCode': user_code,
             'userName': user_name
         }
+        rendered = render_template("second_confirmation", data)
         return EmailMessage(
             sender=WARSJAVA_SENDER_EMAIL,
-            subject=substitute_variables(template['subject'], data),
-            text=substitute_variables(template['body-plain'], data),
-            html=substitute_variables(template['body-html'], data),
+            subject=rendered['subject'],
+            text=rendered['body-plain'],
+            html=rendered['body-html'],
             date=datetime.datetime.now()
         )
 
 
+report_handlers = {}
+
+
+def report_handler(name):
+    def register(handler):
+        report_handlers[name] = handler
+        return handler
+
+    return register
+
+
+# Sends a single message (recipients is None) or a batch message. A report is a (handler name, arguments) pair
+# rather than a callback, so that it can be stored together with the message in the outbox.
+def deliver(recipients, data, report=None, priority=mailqueue.BULK):
+    if recipients is None:
+        return mailgunresource.send_mail_raw(priority, data=data)
+    with mailgunresource.reported_as(report):
+        results = mailgunresource.send_batch_raw(recipients, data, priority)
+    if report is not None:
+        name, arguments = report
+        report_handlers[name](results, **arguments)
+    return results
+
+
+def report_replayed(report, request, mailgun_result):
+    # a batch resent from mail_errors is reported like the delivery of the original message
+    name, arguments = report
+    message_id = mailgun_result.json().get('id')
+    results = {recipient: {'status_code': mailgun_result.status_code, 'id': message_id}
+               for recipient in request['data']['to'].split(', ')}
+    report_handlers[name](results, **arguments)
+
+
+class DispatcherBackend():
+    # Messages that cannot be sent while the Mailgun circuit is open are handed over to the `deferred` backend
+    def __init__(self, deferred=None):
+        self.deferred = deferred
+
+    def submit(self, recipients, data, report=None, priority=mailqueue.BULK):
+        return mailqueue.dispatcher.submit_with_priority(priority, self._deliver, recipients, data, report, priority)
+
+    def _deliver(self, recipients, data, report, priority):
+        try:
+            return deliver(recipients, data, report, priority)
+        except CircuitOpenError:
+            if self.deferred is None:
+                raise
+            return self.deferred.append(recipients, data, report, priority)
+
+
+delivery_backend = DispatcherBackend()
+
+
+def use_delivery_backend(backend):
+    global delivery_backend
+    delivery_backend = backend
+
+
 class EmailMessage():
-    def __init__(self, subject, text, sender=None, html=None, date=None, files=None, raw_message=None, email_id=None):
+    def __init__(self, subject, text, sender=None, html=None, date=None, files=None, raw_message=None, email_id=None,
+                 priority=mailqueue.BULK):
         self.email_id = email_id
+        self.priority = priority
         self.sender = sender
         self.subject = subject
         self.text = text
@@ -155,9 +227,13 @@ class EmailMessage():
         }
 
     def send(self, to):
-        mailgunresource.send_mail_raw(
-            data=self.as_request_to_send(recipient=to)
-        )
+        return delivery_backend.submit(None, self.as_request_to_send(recipient=to), priority=self.priority)
+
+    def send_batch(self, recipients, batch_size=mailgunresource.MAILGUN_BATCH_SIZE, report=None, backend=None):
+        data = self.as_request_to_send(recipient=None)
+        backend = backend or delivery_backend
+        return [backend.submit(recipients[i:i + batch_size], data, report, self.priority)
+                for i in range(0, len(recipients), batch_size)]
 
     @classmethod
     def from_db_dict(cls, value):
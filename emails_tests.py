@@ -0,0 +1,24 @@
+import string
+import unittest
+
+import emails
+from emails import EmailMessage, MailMessageCreator
+
+
+class TemplatesTest(unittest.TestCase):
+    def test_should_compile_templates_when_loaded(self):
+        self.assertIsInstance(emails.templates["workshop_mail"]["subject"], string.Template)
+
+    def test_should_render_forwarded_message(self):
+        message = EmailMessage("Forwarded subject", "text", sender="mentor@example.com")
+        workshop = {"workshopId": "test_workshop", "name": "Workshop Name"}
+
+        forwarded = MailMessageCreator.forward_workshop_message(message, workshop)
+
+        self.assertEqual("Warsjawa - Workshop Name: Forwarded subject", forwarded.subject)
+        self.assertIn("text", forwarded.text)
+        self.assertIsNone(forwarded.html)
+
+
+if __name__ == '__main__':
+    unittest.main()
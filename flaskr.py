@@ -4,23 +4,63 @@ import re
 import os
 import binascii
 import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
 from functools import wraps
+from contextlib import contextmanager
 
-from flask import Flask, make_response, Response
+from flask import Flask, make_response, Response, stream_with_context, has_app_context
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError, BulkWriteError
 from flask import request, g, jsonify, json
 import yaml
 
-from emails import MailMessageCreator, EmailMessage, generate_email_id
+from bulk import bulk_write, insert, update_one
+from cache import TTLCache, IndexedSnapshot
+from campaigns import CampaignRunner, campaign_status
+from emails import MailMessageCreator, EmailMessage, generate_email_id, report_handler, deliver, use_delivery_backend, \
+    DispatcherBackend
+import indexes
 import mailgunresource
+import mailqueue
+import metrics
+from outbox import Outbox, OutboxWorker
+import requestlog
+from ratelimit import MemoryRateLimiter, MongoRateLimiter, MongoTokenBucket
 
 
 app = Flask(__name__)
-handler = logging.StreamHandler()
-handler.setLevel(logging.DEBUG)
-handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-app.logger.addHandler(handler)
-app.logger.setLevel(logging.DEBUG)
+app.config.update(
+    LOG_LEVEL=os.environ.get('LOG_LEVEL', 'INFO'),
+    LOG_LEVELS=requestlog.parse_settings(os.environ.get('LOG_LEVELS')),
+    REQUEST_LOG_MAX_BODY=int(os.environ.get('REQUEST_LOG_MAX_BODY', 1000)),
+    REQUEST_LOG_REDACTED_FIELDS=os.environ.get('REQUEST_LOG_REDACTED_FIELDS', 'key,signature,token').split(','),
+    REQUEST_LOG_SAMPLE_RATE=float(os.environ.get('REQUEST_LOG_SAMPLE_RATE', 1.0)),
+    REQUEST_LOG_SAMPLE_RATES=requestlog.parse_settings(os.environ.get('REQUEST_LOG_SAMPLE_RATES'), float),
+    MONGO_HOST=os.environ.get('MONGO_HOST', 'db'),
+    MONGO_PORT=int(os.environ.get('MONGO_PORT', 27017)),
+    MONGO_DB=os.environ.get('MONGO_DB', 'warsjawa'),
+    MONGO_MAX_POOL_SIZE=int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+    MONGO_CONNECT_TIMEOUT_MS=int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+    MONGO_SOCKET_TIMEOUT_MS=int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 10000)),
+    MONGO_WAIT_QUEUE_TIMEOUT_MS=int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+    RATE_LIMIT_BACKEND=os.environ.get('RATE_LIMIT_BACKEND', 'memory'),
+    RATE_LIMIT_WINDOW_SECONDS=int(os.environ.get('RATE_LIMIT_WINDOW_SECONDS', 3600)),
+    MAILGUN_RATE_LIMIT_BACKEND=os.environ.get('MAILGUN_RATE_LIMIT_BACKEND', 'memory'),
+    TAG_CACHE_SIZE=int(os.environ.get('TAG_CACHE_SIZE', 5000)),
+    TAG_CACHE_TTL_SECONDS=int(os.environ.get('TAG_CACHE_TTL_SECONDS', 300)),
+    TAG_CACHE_CHECK_SECONDS=float(os.environ.get('TAG_CACHE_CHECK_SECONDS', 5)),
+    WORKSHOP_REGISTRY_CHECK_SECONDS=float(os.environ.get('WORKSHOP_REGISTRY_CHECK_SECONDS', 5)),
+    DELIVERY_RETRY_SECONDS=int(os.environ.get('DELIVERY_RETRY_SECONDS', 3600)),
+    MAIL_DELIVERY_BACKEND=os.environ.get('MAIL_DELIVERY_BACKEND', 'dispatcher'),
+    OUTBOX_WORKER_THREADS=int(os.environ.get('OUTBOX_WORKER_THREADS', 1)),
+    OUTBOX_BATCH_SIZE=int(os.environ.get('OUTBOX_BATCH_SIZE', 20)),
+    OUTBOX_LEASE_SECONDS=int(os.environ.get('OUTBOX_LEASE_SECONDS', 60)),
+    OUTBOX_MAX_ATTEMPTS=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+)
 
 
 def simple_response(message, success, **kwargs):
@@ -37,13 +77,76 @@ def success_response(message, **kwargs):
     return simple_response(message, True, **kwargs)
 
 
+_mongo_client = None
+_mongo_client_pid = None
+_mongo_client_lock = threading.Lock()
+
+
+def get_mongo_client():
+    global _mongo_client, _mongo_client_pid
+    # MongoClient is not fork-safe, so a forked worker process builds its own client and pool
+    if _mongo_client is None or _mongo_client_pid != os.getpid():
+        with _mongo_client_lock:
+            if _mongo_client is None or _mongo_client_pid != os.getpid():
+                _mongo_client = MongoClient(
+                    app.config['MONGO_HOST'],
+                    app.config['MONGO_PORT'],
+                    max_pool_size=app.config['MONGO_MAX_POOL_SIZE'],
+                    connectTimeoutMS=app.config['MONGO_CONNECT_TIMEOUT_MS'],
+                    socketTimeoutMS=app.config['MONGO_SOCKET_TIMEOUT_MS'],
+                    waitQueueTimeoutMS=app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS']
+                )
+                _mongo_client_pid = os.getpid()
+    return _mongo_client
+
+
 def get_db():
     if not hasattr(g, 'db'):
-        g.db = MongoClient('db', 27017).warsjawa
+        g.db = metrics.InstrumentedDatabase(get_mongo_client()[app.config['MONGO_DB']])
     return g.db
 
 
-def load_workshops():
+@contextmanager
+def mail_delivery_context():
+    with app.app_context():
+        yield
+
+
+def get_collection(name):
+    # for mail delivery, which also runs outside of the application context
+    if has_app_context():
+        return get_db()[name]
+    return get_mongo_client()[app.config['MONGO_DB']][name]
+
+
+def get_mail_errors():
+    return get_collection('mail_errors')
+
+
+mailqueue.dispatcher.job_context = mail_delivery_context
+mailgunresource.error_collection = get_mail_errors
+if app.config['MAILGUN_RATE_LIMIT_BACKEND'] == 'mongo':
+    mailgunresource.send_limit = MongoTokenBucket(lambda: get_collection('token_buckets'), 'mailgun',
+                                                  mailgunresource.send_limit.rate,
+                                                  mailgunresource.send_limit.capacity)
+
+outbox = Outbox(lambda: get_db().outbox, batch_size=app.config['OUTBOX_BATCH_SIZE'],
+                lease_seconds=app.config['OUTBOX_LEASE_SECONDS'], max_attempts=app.config['OUTBOX_MAX_ATTEMPTS'])
+
+
+def deliver_from_outbox(recipients, data, report=None, priority=mailqueue.BULK):
+    with mailgunresource.errors_handled_by_caller():
+        return deliver(recipients, data, report, priority)
+
+
+outbox_worker = OutboxWorker(outbox, deliver_from_outbox, mail_delivery_context, threads=app.config['OUTBOX_WORKER_THREADS'])
+if app.config['MAIL_DELIVERY_BACKEND'] == 'outbox':
+    use_delivery_backend(outbox)
+else:
+    use_delivery_backend(DispatcherBackend(deferred=outbox))
+
+
+def load_workshops(path="workshops.yml"):
     def generate_workshop_email_secret():
         return binascii.hexlify(os.urandom(8)).decode('UTF-8')
 
@@ -54,65 +157,155 @@ def load_workshops():
             'name': yaml_data['name'],
             'mentors': yaml_data['mentors'],
             'users': [],
-            'emails': []
+            'welcomeEmailSent': False
         }
         return new_workshop
 
-    yaml_file = open("workshops.yml", encoding="utf-8")
+    yaml_file = open(path, encoding="utf-8")
     workshops = yaml.load(yaml_file)['workshops']
-    app.logger.info("There are %d workshops" % len(workshops))
+    workshops_in_db = {workshop['workshopId']: workshop for workshop in get_db().workshops.find(
+        {"workshopId": {"$in": [workshop_data['workshopId'] for workshop_data in workshops]}},
+        {"workshopId": 1, "name": 1, "mentors": 1})}
+    operations, added, updated = [], [], []
     for workshop_data in workshops:
-        workshop_in_db = get_db().workshops.find_one({"workshopId": workshop_data['workshopId']})
-        if workshop_in_db is not None:
-            app.logger.debug("Skipping %s" % workshop_data)
-            continue  # skip already inserted
-        else:
-            workshop_in_db = create_workshop(workshop_data)
-            get_db().workshops.insert(workshop_in_db)
-            welcome_message = MailMessageCreator.mentor_welcome_email(workshop_in_db['name'],
-                                                                      workshop_in_db['emailSecret'])
-            for email in workshop_in_db['mentors']:
-                welcome_message.send(to=email)
-            app.logger.info("Added %s" % workshop_data)
+        workshop_in_db = workshops_in_db.get(workshop_data['workshopId'])
+        if workshop_in_db is None:
+            operations.append(insert(create_workshop(workshop_data)))
+            added.append(workshop_data['workshopId'])
+        elif (workshop_in_db['name'], workshop_in_db['mentors']) != (workshop_data['name'], workshop_data['mentors']):
+            operations.append(update_one({"workshopId": workshop_data['workshopId']},
+                                         {"$set": {"name": workshop_data['name'], "mentors": workshop_data['mentors']}}))
+            updated.append(workshop_data['workshopId'])
+
+    result = bulk_write(get_db().workshops, operations, ignore_duplicates=True)
+    if operations:
+        bump_workshops_version()
+        workshop_registry.clear()
+    # a workshop inserted by another process in the meantime is rejected by the unique workshopId index
+    rejected = {error['op']['workshopId'] for error in result['writeErrors'] if error['code'] == 11000}
+    changes = {
+        "added": [workshop_id for workshop_id in added if workshop_id not in rejected],
+        "updated": updated,
+        "unchanged": len(workshops) - len(added) - len(updated) + len(rejected)
+    }
+    app.logger.info("There are %d workshops, added: %s, updated: %s, unchanged: %d", len(workshops),
+                    changes['added'], changes['updated'], changes['unchanged'])
+    return changes
+
+
+def get_workshops_version():
+    workshops = get_db().meta.find_one({"_id": "workshops"}, {"version": 1})
+    return workshops['version'] if workshops is not None else 0
+
+
+def bump_workshops_version():
+    # must be called whenever workshop metadata changes, every process reloads its workshop_registry
+    get_db().meta.update({"_id": "workshops"}, {"$inc": {"version": 1}}, upsert=True)
+
+
+WORKSHOP_METADATA_FIELDS = {"_id": 0, "workshopId": 1, "name": 1, "mentors": 1, "emailSecret": 1}
+
+# Workshop metadata changes only through load_workshops, users registered for a workshop are always read from
+# the database
+workshop_registry = IndexedSnapshot(lambda: list(get_db().workshops.find({}, WORKSHOP_METADATA_FIELDS)),
+                                    get_workshops_version, keys=("workshopId", "emailSecret"),
+                                    check_interval=app.config['WORKSHOP_REGISTRY_CHECK_SECONDS'])
+
+
+def send_welcome_emails():
+    # Runs in the master before workers are forked, so the emails are only appended to the outbox and delivered by
+    # the outbox workers. A workshop is marked as queued first, so concurrent deployments queue its email once.
+    for workshop in get_db().workshops.find({"welcomeEmailSent": False, "welcomeEmailQueued": {"$ne": True}},
+                                            {"workshopId": 1, "name": 1, "emailSecret": 1, "mentors": 1}):
+        queued = get_db().workshops.update({"_id": workshop['_id'], "welcomeEmailQueued": {"$ne": True}},
+                                           {"$set": {"welcomeEmailQueued": True}})
+        if queued['updatedExisting']:
+            welcome_message = MailMessageCreator.mentor_welcome_email(workshop['name'], workshop['emailSecret'])
+            welcome_message.send_batch(workshop['mentors'], backend=outbox,
+                                       report=("welcome", {"workshop_id": workshop['workshopId']}))
+
+
+@report_handler("welcome")
+def record_welcome(results, workshop_id):
+    if all(result['status_code'] == 200 for result in results.values()):
+        get_db().workshops.update({"workshopId": workshop_id}, {"$set": {"welcomeEmailSent": True}})
+    else:
+        app.logger.error("Welcome email for workshop %s was not sent, the outbox retries it", workshop_id)
+
+
+requestlog.configure_logging(app.config['LOG_LEVEL'], app.config['LOG_LEVELS'])
+request_logger = requestlog.RequestLogger(
+    logging.getLogger('access'),
+    max_body=app.config['REQUEST_LOG_MAX_BODY'],
+    redacted_fields=app.config['REQUEST_LOG_REDACTED_FIELDS'],
+    sample_rates=app.config['REQUEST_LOG_SAMPLE_RATES'],
+    default_sample_rate=app.config['REQUEST_LOG_SAMPLE_RATE']
+)
 
 
 def with_logging():
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            app.logger.debug("%s: %s", request, request.get_data(as_text=True, parse_form_data=True))
-            rv = f(*args, **kwargs)
-            response = None
-            if isinstance(rv, Response):
-                response = rv
-            elif type(rv) is tuple and isinstance(rv[0], Response):
-                response = rv[0]
-            if response is not None:
-                app.logger.debug("Response: %s, %s", rv, response.get_data())
-            else:
-                app.logger.debug("Response: %s", rv)
-            return rv
+            started_at = time.time()
+            response = make_response(f(*args, **kwargs))
+            request_logger.log(response, started_at, mongoOperations=g.get('mongo_operations', 0),
+                               mongoMs=round(g.get('mongo_seconds', 0.0) * 1000, 1))
+            return response
 
         return decorated_function
 
     return decorator
 
 
-def is_over_limit(group, source_id):
-    return get_db().invocations.find({"group": group, "source": source_id}).count() > 50
+http_requests = metrics.registry.histogram('http_request_duration_seconds', 'Duration of HTTP requests.',
+                                           labels=('endpoint', 'method'))
+http_responses = metrics.registry.counter('http_responses_total', 'HTTP responses by status code.',
+                                          labels=('endpoint', 'method', 'status'))
+http_exceptions = metrics.registry.counter('http_request_exceptions_total', 'Unhandled exceptions raised by routes.',
+                                           labels=('endpoint',))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.time()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    http_requests.observe(time.time() - g.request_started_at, endpoint, request.method)
+    http_responses.inc(endpoint, request.method, str(response.status_code))
+    return response
+
+
+@app.teardown_request
+def record_request_exception(exception):
+    if exception is not None:
+        http_exceptions.inc(request.endpoint or 'unknown')
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def create_rate_limiter():
+    window = app.config['RATE_LIMIT_WINDOW_SECONDS']
+    if app.config['RATE_LIMIT_BACKEND'] == 'mongo':
+        return MongoRateLimiter(lambda: get_db().invocations, window)
+    return MemoryRateLimiter(window)
 
 
-def store_invocation(group, source_id):
-    get_db().invocations.insert({"group": group, "source": source_id, "timestamp": datetime.datetime.utcnow()})
+rate_limiter = create_rate_limiter()
 
 
-def limited(group, id_key):
+def limited(group, id_key, limit=50):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             id_value = request.args.get(id_key)
-            store_invocation(group, id_value)
-            if is_over_limit(group, id_value):
+            if rate_limiter.hit(group, id_value) > limit:
                 return error_response("Limit exceeded"), 429
             else:
                 return f(*args, **kwargs)
@@ -135,6 +328,8 @@ def is_valid_vote_request(json):
         return False
     if set(json.keys()) != {"mac", "tagId", "isPositive", "timestamp"}:
         return False
+    if not isinstance(json['mac'], str) or not isinstance(json['tagId'], str):
+        return False
     return True
 
 
@@ -146,7 +341,6 @@ def add_new_user():
         return error_response("Invalid request. Should contain only 'email' and 'name'."), 400
     request_json['key'] = binascii.hexlify(os.urandom(128)).decode('UTF-8')
     request_json['isConfirmed'] = False
-    request_json['emails'] = []
 
     find_result = get_db().users.find_one({"email": request_json['email']})
     if find_result is None or find_result['isConfirmed'] is False:
@@ -186,6 +380,7 @@ def confirm_new_user():
 
     if find_result['n'] > 0:
         if not was_already_confirmed:
+            bump_contacts_version()
             message = MailMessageCreator.user_confirmation(user['name'], user['key'], request_json['email'])
             message.send(to=request_json['email'])
         return success_response("User is confirmed now.", name=user['name']), 200
@@ -194,6 +389,10 @@ def confirm_new_user():
         return error_response("Invalid key."), 403
 
 
+WORKSHOP_EMAILS_ORDER = [("date", 1), ("_id", 1)]
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
 @app.route('/emails/<workshop_id>/<attender_email>', methods=['PUT'])
 @with_logging()
 def register_new_user_for_workshop(workshop_id, attender_email):
@@ -203,16 +402,16 @@ def register_new_user_for_workshop(workshop_id, attender_email):
     elif user['isConfirmed'] is not True:
         return error_response("User %s not confirmed" % attender_email), 412
 
-    workshop = get_db().workshops.find_and_modify(
-        query={"workshopId": workshop_id},
-        update={"$addToSet": {"users": attender_email}}
-    )
+    workshop = workshop_registry.get("workshopId", workshop_id)
     if workshop is None:
         return error_response("Workshop %s not found" % workshop_id), 404
-    if attender_email in workshop['users']:
+    update_result = get_db().workshops.update({"workshopId": workshop_id, "users": {"$ne": attender_email}},
+                                              {"$addToSet": {"users": attender_email}})
+    if not update_result['updatedExisting']:
         return error_response("User %s is already registered for %s" % (attender_email, workshop_id)), 304
-    workshop['emails'] = [EmailMessage.from_db_dict(e) for e in workshop['emails']]
-    ensure_mails_were_sent_to_users(workshop['emails'], [attender_email], workshop)
+    emails = [EmailMessage.from_db_dict(e) for e in
+              get_db().workshop_emails.find({"workshopId": workshop_id}).sort(WORKSHOP_EMAILS_ORDER)]
+    ensure_mails_were_sent_to_users(emails, [attender_email], workshop)
     return success_response("User %s registered for %s" % (attender_email, workshop_id)), 200
 
 
@@ -226,18 +425,73 @@ def unregister_user_from_workshop(workshop_id, attender_email):
         return error_response("Workshop %s not found" % workshop_id), 404
 
 
+def encode_emails_cursor(email):
+    since_epoch = email['date'] - EPOCH
+    microseconds = (since_epoch.days * 86400 + since_epoch.seconds) * 10 ** 6 + since_epoch.microseconds
+    return "%d-%s" % (microseconds, email['_id'])
+
+
+def decode_emails_cursor(cursor):
+    microseconds, email_id = cursor.split("-", 1)
+    return EPOCH + datetime.timedelta(microseconds=int(microseconds)), ObjectId(email_id)
+
+
+def parse_limit(default, maximum):
+    # raises ValueError for a limit which is not a positive number
+    limit = int(request.args.get('limit', default))
+    if limit < 1:
+        raise ValueError("Invalid limit: %d" % limit)
+    return min(limit, maximum)
+
+
+def parse_since(since):
+    for date_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(since, date_format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date: %s" % since)
+
+
 @app.route("/emails/<workshop_id>", methods=['GET'])
 @with_logging()
 def get_workshop_emails(workshop_id):
-    # Well, I could use aggregation, but it is not implemented in mongomock :(
-    data = get_db().workshops.find_one({"workshopId": workshop_id}, {"emails.emailId": 0})
-
-    if data is None:
+    if workshop_registry.get("workshopId", workshop_id) is None:
         return error_response("Workshop %s not found" % workshop_id), 404
 
-    emails = [EmailMessage.from_db_dict(email).as_response() for email in data['emails']]
-    json_data = jsonify(emails=emails)
-    return json_data
+    conditions = [{"workshopId": workshop_id}]
+    try:
+        limit = parse_limit(100, 500)
+        if request.args.get('since'):
+            conditions.append({"date": {"$gte": parse_since(request.args['since'])}})
+        if request.args.get('cursor'):
+            date, email_id = decode_emails_cursor(request.args['cursor'])
+            conditions.append({"$or": [{"date": {"$gt": date}}, {"date": date, "_id": {"$gt": email_id}}]})
+    except (ValueError, InvalidId):
+        return error_response("Invalid 'limit', 'since' or 'cursor' parameter."), 400
+
+    query = conditions[0] if len(conditions) == 1 else {"$and": conditions}
+    emails = list(get_db().workshop_emails.find(query, {"email_id": 0, "raw_message": 0, "files": 0})
+                  .sort(WORKSHOP_EMAILS_ORDER).limit(limit + 1))
+    response = {"emails": [EmailMessage.from_db_dict(email).as_response() for email in emails[:limit]]}
+    if len(emails) > limit:
+        response["next"] = encode_emails_cursor(emails[limit - 1])
+    return jsonify(**response)
+
+
+@app.route("/emails/<workshop_id>/deliveries", methods=['GET'])
+@with_logging()
+def get_workshop_deliveries(workshop_id):
+    if workshop_registry.get("workshopId", workshop_id) is None:
+        return error_response("Workshop %s not found" % workshop_id), 404
+    emails = list(get_db().workshop_emails.find({"workshopId": workshop_id}, {"email_id": 1, "subject": 1, "date": 1})
+                  .sort(WORKSHOP_EMAILS_ORDER))
+    counts = defaultdict(lambda: {"queued": 0, "sent": 0, "failed": 0})
+    for delivery in get_db().deliveries.find({"email_id": {"$in": [email['email_id'] for email in emails]}},
+                                             {"email_id": 1, "status": 1}):
+        counts[delivery['email_id']][delivery['status']] += 1
+    return jsonify(deliveries=[dict(counts[email['email_id']], subject=email['subject'], date=email['date'])
+                               for email in emails])
 
 
 def get_workshop_secret_from_email_address(email_address):
@@ -257,53 +511,123 @@ def accept_incoming_emails():
         sender=request.form['from'],
         subject=request.form['subject'],
         text=request.form.get('body-plain'),
-        html=request.form.get('body-html')
+        html=request.form.get('body-html'),
+        date=datetime.datetime.utcnow()
     )
     workshop_secret = get_workshop_secret_from_email_address(email_address)
-    workshop = get_db().workshops.find_and_modify(
-        query={"emailSecret": workshop_secret},
-        update={"$push": {"emails": email.as_db_dict()}}
-    )
+    workshop = workshop_registry.get("emailSecret", workshop_secret)
     if workshop is None:
         return error_response("Workshop not found"), 404  # TODO send reply that invalid email was sent?
+    get_db().workshop_emails.insert(dict(email.as_db_dict(), workshopId=workshop['workshopId']))
 
-    ensure_mails_were_sent_to_users([email], workshop['users'], workshop)
+    members = get_db().workshops.find_one({"workshopId": workshop['workshopId']}, {"users": 1})
+    ensure_mails_were_sent_to_users([email], members['users'] if members is not None else [], workshop)
     ensure_mail_were_sent_to_mentors(email, workshop['mentors'], workshop)
     return success_response("Email processed.")
 
 
-def ensure_email_is_sent_to_user(email_message, user_email, workshop):
-    update_result = get_db().users.update(
-        {"email": user_email,
-         "emails": {"$ne": email_message.email_id}},
-        {"$addToSet": {"emails": email_message.email_id}}
-    )
-    if update_result['n'] == 0:  # no documents updated so user not exists or already seen this mail
-        return
-    else:
-        message_to_send = MailMessageCreator.forward_workshop_message(email_message, workshop)
-        message_to_send.send(to=user_email)
+def new_delivery(email_id, recipient, date):
+    return {
+        "email_id": email_id,
+        "recipient": recipient,
+        "status": "queued",
+        "mailgunId": None,
+        "createdAt": date,
+        "updatedAt": date
+    }
+
+
+@report_handler("deliveries")
+def record_deliveries(results, email_id):
+    now = datetime.datetime.utcnow()
+    bulk_write(get_db().deliveries, [
+        update_one({"email_id": email_id, "recipient": recipient},
+                   {"$set": {"status": "sent" if result['status_code'] == 200 else "failed",
+                             "statusCode": result['status_code'],
+                             "mailgunId": result['id'],
+                             "updatedAt": now}})
+        for recipient, result in results.items()
+    ])
 
 
 def ensure_mails_were_sent_to_users(email_messages, users_emails, workshop):
+    if not email_messages or not users_emails:
+        return
+    users = [user['email'] for user in get_db().users.find({"email": {"$in": list(users_emails)}}, {"email": 1})]
+    email_ids = [email_message.email_id for email_message in email_messages]
+    deliveries = {(delivery['email_id'], delivery['recipient']): delivery for delivery in get_db().deliveries.find(
+        {"email_id": {"$in": email_ids}, "recipient": {"$in": users}},
+        {"email_id": 1, "recipient": 1, "status": 1, "updatedAt": 1})}
+    now = datetime.datetime.utcnow()
+    pending = [new_delivery(email_id, user, now) for email_id in email_ids for user in users
+               if (email_id, user) not in deliveries]
+
+    # the unique (email_id, recipient) index rejects deliveries queued by a concurrent request in the meantime
+    result = bulk_write(get_db().deliveries, [insert(delivery) for delivery in pending], ignore_duplicates=True)
+    rejected = {(error['op']['email_id'], error['op']['recipient']) for error in result['writeErrors']
+                if error['code'] == 11000}
+    queued = [(delivery['email_id'], delivery['recipient']) for delivery in pending
+              if (delivery['email_id'], delivery['recipient']) not in rejected]
+    queued.extend(retry_deliveries(deliveries.values(), now))
     for email_message in email_messages:
-        for user_email in users_emails:
-            ensure_email_is_sent_to_user(email_message, user_email, workshop)
+        recipients = [recipient for email_id, recipient in queued if email_id == email_message.email_id]
+        if recipients:
+            MailMessageCreator.forward_workshop_message(email_message, workshop).send_batch(
+                recipients, report=("deliveries", {"email_id": email_message.email_id}))
+
+
+def retry_deliveries(deliveries, now):
+    # deliveries queued long ago without a report were lost with the process sending them, they are queued again and
+    # the update conditional on the read state makes sure only one request retries each of them. Failed deliveries
+    # are resent by the outbox or the mail_errors replay, which reports them as sent.
+    stale = now - datetime.timedelta(seconds=app.config['DELIVERY_RETRY_SECONDS'])
+    retried = []
+    for delivery in deliveries:
+        if delivery['status'] == "queued" and delivery['updatedAt'] < stale:
+            update_result = get_db().deliveries.update(
+                {"_id": delivery['_id'], "status": "queued", "updatedAt": delivery['updatedAt']},
+                {"$set": {"updatedAt": now}})
+            if update_result['updatedExisting']:
+                retried.append((delivery['email_id'], delivery['recipient']))
+    return retried
 
 
 def ensure_mail_were_sent_to_mentors(email_message, mentor_emails, workshop):
-    for mentor_email in mentor_emails:
+    if mentor_emails:
         message_to_send = MailMessageCreator.forward_workshop_message(email_message, workshop)
-        message_to_send.send(to=mentor_email)
+        message_to_send.send_batch(list(mentor_emails))
+
+
+def get_contacts_version():
+    contacts = get_db().meta.find_one({"_id": "contacts"}, {"version": 1})
+    return contacts['version'] if contacts is not None else 0
+
+
+def bump_contacts_version():
+    # must be called whenever a confirmed user is added or changed, it invalidates ETags of /contacts
+    get_db().meta.update({"_id": "contacts"}, {"$inc": {"version": 1}}, upsert=True)
 
 
 @app.route("/contacts", methods=['GET'])
 @with_logging()
 def get_all_users():
+    etag = "contacts-%d" % get_contacts_version()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+
     users = get_db().users.find({"isConfirmed": True}, {"name": 1, "email": 1})
-    result = [{"name": user['name'], "email": user['email']} for user in users]
-    response = make_response(json.dumps(result, ensure_ascii=False))
-    response.content_type = "application/json"
+
+    def generate():
+        yield "["
+        for index, user in enumerate(users):
+            user_json = json.dumps({"name": user['name'], "email": user['email']}, ensure_ascii=False)
+            yield user_json if index == 0 else ", " + user_json
+        yield "]"
+
+    response = Response(stream_with_context(generate()), content_type="application/json")
+    response.set_etag(etag)
     return response
 
 
@@ -324,15 +648,47 @@ def associate_tag_with_user(user_email, tag_id):
         app.logger.info('Tag "%s" removed from user "%s" in order to add to "%s"', tag_id, old_tag_owner['email'], user_email)
 
     update_result = get_db().users.update({"email": user_email}, {"$addToSet": {"nfcTags": tag_id}})
+    # the tag entry points to the old owner (or to nobody) until the new owner is loaded again, also in the tag
+    # caches of other processes
+    bump_tags_version()
+    tag_cache.invalidate(tag_id)
     if not update_result['ok'] == 1:
         return error_response('Unable to associate tag "%s" with user "%s"' % (tag_id, user_email)), 500
     return success_response('User "%s" is associated with tag "%s"' % (user_email, tag_id)), 201
 
 
+def get_tags_version():
+    tags = get_db().meta.find_one({"_id": "tags"}, {"version": 1})
+    return tags['version'] if tags is not None else 0
+
+
+def bump_tags_version():
+    # must be called whenever a tag changes its owner, it drops the tag_cache of every process
+    get_db().meta.update({"_id": "tags"}, {"$inc": {"version": 1}}, upsert=True)
+
+
+tag_cache = TTLCache(max_size=app.config['TAG_CACHE_SIZE'], ttl=app.config['TAG_CACHE_TTL_SECONDS'],
+                     version=get_tags_version, check_interval=app.config['TAG_CACHE_CHECK_SECONDS'])
+
+
 def find_user_for_tag(tag_id):
-    users = list(get_db().users.find({"nfcTags": tag_id}, {"name": 1, "email": 1}))
-    assert len(users) <= 1
-    return users[0] if users else None
+    def load_user():
+        users = list(get_db().users.find({"nfcTags": tag_id}, {"name": 1, "email": 1}))
+        assert len(users) <= 1
+        return users[0] if users else None
+
+    return tag_cache.get_or_load(tag_id, load_user)
+
+
+def find_users_for_tags(tag_ids):
+    def load_users(not_cached_tag_ids):
+        users = {}
+        for user in get_db().users.find({"nfcTags": {"$in": not_cached_tag_ids}}, {"name": 1, "email": 1, "nfcTags": 1}):
+            for tag_id in user.pop('nfcTags'):
+                users[tag_id] = user
+        return users
+
+    return tag_cache.get_or_load_many(tag_ids, load_users)
 
 
 @app.route("/contact/<tag_id>", methods=['GET'])
@@ -345,6 +701,49 @@ def find_user_by_tag(tag_id):
     return jsonify(name=user['name'], email=user['email'])
 
 
+def create_vote(vote_request, user):
+    return {
+        "mac": vote_request['mac'],
+        "tagId": vote_request['tagId'],
+        "userEmail": user['email'] if user is not None else None,
+        "vote": 1 if vote_request['isPositive'] else -1,
+        "timestamp": vote_request['timestamp'],
+        "date": datetime.datetime.utcnow()
+    }
+
+
+def vote_response(previous_vote, vote):
+    if previous_vote is None:
+        return "Vote added.", 201
+    elif previous_vote == vote:
+        return "Vote not modified.", 304
+    else:
+        return "Vote changed.", 200
+
+
+def add_tally_changes(tally_changes, previous_vote, vote):
+    # the previous vote is taken back from the user it was counted for, tag could have changed its owner since
+    if previous_vote is not None and previous_vote.get('vote') is not None:
+        for tally_id in [("user", previous_vote.get('userEmail')), ("reader", vote['mac'])]:
+            tally_changes[tally_id]["score"] -= previous_vote['vote']
+            tally_changes[tally_id]["votes"] -= 1
+    for tally_id in [("user", vote['userEmail']), ("reader", vote['mac'])]:
+        tally_changes[tally_id]["score"] += vote['vote']
+        tally_changes[tally_id]["votes"] += 1
+
+
+def update_vote_tallies(tally_changes):
+    bulk_write(get_db().vote_tallies, [
+        update_one({"kind": kind, "key": key}, {"$inc": changes}, upsert=True)
+        for (kind, key), changes in tally_changes.items()
+        if key is not None and any(changes.values())
+    ])
+
+
+def new_tally_changes():
+    return defaultdict(lambda: {"score": 0, "votes": 0})
+
+
 @app.route('/vote', methods=['POST'])
 @with_logging()
 def add_new_vote():
@@ -352,32 +751,134 @@ def add_new_vote():
     if not is_valid_vote_request(request_json):
         return error_response("Invalid request. "), 400
     user = find_user_for_tag(request_json['tagId'])
-    vote_id = {
-        "mac": request_json['mac'],
-        "tagId": request_json['tagId']
-    }
-    vote = {
-        "userEmail": user['email'] if user is not None else None,
-        "vote": 1 if request_json['isPositive'] else -1,
-        "timestamp": request_json['timestamp'],
-        "date": datetime.datetime.utcnow()
-    }
-    update_result = get_db().votes.find_and_modify(
-        query=vote_id,
-        update={"$push": {"votes": vote}},
+    vote = create_vote(request_json, user)
+    previous_vote = get_db().votes.find_and_modify(
+        query={"mac": vote['mac'], "tagId": vote['tagId']},
+        update={"$set": vote},
         upsert=True,
-        full_response=True,
-        new=False
+        new=False,
+        fields={"vote": 1, "userEmail": 1}
     )
-    if update_result['ok'] != 1:
-        app.logger.error("Error while adding vote! %s", update_result)
-        error_response("Error while adding vote!"), 500
-    elif update_result['lastErrorObject']['updatedExisting']:
-        if update_result['value']['votes'][-1]['vote'] == vote['vote']:
-            return success_response("Vote not modified."), 304
-        else:
-            return success_response("Vote changed."), 200
-    return success_response("Vote added."), 201
+    get_db().vote_history.insert(dict(vote))
+    tally_changes = new_tally_changes()
+    add_tally_changes(tally_changes, previous_vote, vote)
+    update_vote_tallies(tally_changes)
+    message, status = vote_response(previous_vote and previous_vote.get('vote'), vote['vote'])
+    return success_response(message), status
+
+
+@app.route('/votes/batch', methods=['POST'])
+@with_logging()
+def add_new_votes():
+    request_json = request.get_json(force=True, silent=True)
+    if not isinstance(request_json, list):
+        return error_response("Invalid request. Should be a list of votes."), 400
+    valid_requests = [vote_request for vote_request in request_json if is_valid_vote_request(vote_request)]
+    users = find_users_for_tags({vote_request['tagId'] for vote_request in valid_requests})
+    vote_ids = {(vote_request['mac'], vote_request['tagId']) for vote_request in valid_requests}
+    current_votes = {}
+    if vote_ids:
+        query = {"$or": [{"mac": mac, "tagId": tag_id} for mac, tag_id in vote_ids]}
+        for vote in get_db().votes.find(query, {"mac": 1, "tagId": 1, "vote": 1, "userEmail": 1}):
+            current_votes[(vote['mac'], vote['tagId'])] = vote
+
+    # Votes of one (mac, tagId) pair come from a single reader, which replays its buffer sequentially,
+    # so reading current votes upfront does not race with other writers of the same documents.
+    new_votes = []
+    tally_changes = new_tally_changes()
+    results = []
+    for vote_request in request_json:
+        if not is_valid_vote_request(vote_request):
+            results.append({"status": 400, "message": "Invalid request. "})
+            continue
+        vote_id = (vote_request['mac'], vote_request['tagId'])
+        vote = create_vote(vote_request, users[vote_request['tagId']])
+        previous_vote = current_votes.get(vote_id)
+        message, status = vote_response(previous_vote and previous_vote.get('vote'), vote['vote'])
+        results.append({"status": status, "message": message})
+        add_tally_changes(tally_changes, previous_vote, vote)
+        current_votes[vote_id] = vote
+        new_votes.append(vote)
+
+    latest_votes = OrderedDict(((vote['mac'], vote['tagId']), vote) for vote in new_votes)
+    bulk_write(get_db().votes, [update_one({"mac": mac, "tagId": tag_id}, {"$set": vote}, upsert=True)
+                                for (mac, tag_id), vote in latest_votes.items()])
+    bulk_write(get_db().vote_history, [insert(dict(vote)) for vote in new_votes])
+    update_vote_tallies(tally_changes)
+    return success_response("Votes processed.", votes=results), 200
+
+
+def tallies_response(kind, key_name, limit):
+    tallies = get_db().vote_tallies.find({"kind": kind}, {"key": 1, "score": 1, "votes": 1})
+    return [{key_name: tally['key'], "score": tally['score'], "votes": tally['votes']}
+            for tally in tallies.sort([("score", -1)]).limit(limit)]
+
+
+@app.route('/votes/summary', methods=['GET'])
+@with_logging()
+def get_votes_summary():
+    try:
+        limit = parse_limit(10, 100)
+    except ValueError:
+        return error_response("Invalid 'limit' parameter."), 400
+    return success_response("Votes summary.", users=tallies_response("user", "email", limit),
+                            readers=tallies_response("reader", "mac", limit))
+
+
+def migrate_workshop_emails():
+    # Moves messages embedded in workshop documents into the workshop_emails collection
+    for workshop in get_db().workshops.find({"emails": {"$exists": True}}, {"workshopId": 1, "emails": 1}):
+        migrated_at = datetime.datetime.utcnow()
+        emails = [dict(EmailMessage.from_db_dict(email).as_db_dict(), workshopId=workshop['workshopId'])
+                  for email in workshop['emails']]
+        for index, email in enumerate(emails):
+            email['date'] = email['date'] or migrated_at
+            # the unique email_id index makes a rerun after a crash skip emails which were already moved
+            email['email_id'] = email['email_id'] or "%s-%d" % (workshop['_id'], index)
+        try:
+            bulk_write(get_db().workshop_emails, [insert(email) for email in emails], ignore_duplicates=True)
+        except BulkWriteError:
+            app.logger.exception("Emails of workshop %s were not migrated, they are kept in the workshop",
+                                 workshop['workshopId'])
+            continue
+        get_db().workshops.update({"_id": workshop['_id']}, {"$unset": {"emails": ""}})
+        app.logger.info("Migrated %d emails of workshop %s", len(emails), workshop['workshopId'])
+
+
+def migrate_user_emails():
+    # Moves ids of delivered emails stored in user documents into the deliveries collection
+    migrated = 0
+    for user in get_db().users.find({"emails": {"$exists": True}}, {"email": 1, "emails": 1}):
+        migrated_at = datetime.datetime.utcnow()
+        bulk_write(get_db().deliveries, [insert(dict(new_delivery(email_id, user['email'], migrated_at), status="sent"))
+                                         for email_id in user['emails']], ignore_duplicates=True)
+        get_db().users.update({"_id": user['_id']}, {"$unset": {"emails": ""}})
+        migrated += 1
+    if migrated:
+        app.logger.info("Migrated delivered emails of %d users", migrated)
+
+
+def migrate_votes():
+    # Moves votes stored as an ever growing `votes` array into current vote, history and tallies
+    migrated = 0
+    for legacy in get_db().votes.find({"votes": {"$exists": True}}):
+        # ids of history entries are derived from the legacy document, a rerun after a crash skips inserted ones
+        history = [dict(vote, mac=legacy['mac'], tagId=legacy['tagId'], _id="%s-%d" % (legacy['_id'], index))
+                   for index, vote in enumerate(legacy['votes'])]
+        bulk_write(get_db().vote_history, [insert(vote) for vote in history], ignore_duplicates=True)
+        update = {"$unset": {"votes": ""}}
+        if legacy['votes']:
+            update["$set"] = dict(legacy['votes'][-1], mac=legacy['mac'], tagId=legacy['tagId'])
+        converted = get_db().votes.update({"_id": legacy['_id'], "votes": {"$exists": True}}, update)
+        if not converted['updatedExisting']:
+            continue  # converted by a concurrent migration, which counted it
+        if legacy['votes']:
+            tally_changes = new_tally_changes()
+            add_tally_changes(tally_changes, None, update["$set"])
+            update_vote_tallies(tally_changes)
+        migrated += 1
+    if migrated:
+        app.logger.info("Migrated %d legacy vote documents", migrated)
 
 
 def is_valid_sell_data_request(json):
@@ -422,28 +923,70 @@ def confirm_user(user_email):
     <div class="list-group">""" + ''.join(['<a href="http://registration.warsjawa.pl/" class="list-group-item">' + w['name'] + '</a>' for w in workshops]) + '</div></body></html>'
 
 
+campaign_runner = CampaignRunner(lambda: get_db(), app.app_context,
+                                 batch_size=int(os.environ.get('CAMPAIGN_BATCH_SIZE', 100)))
+
 
 @app.route('/send_confirmation', methods=['POST'])
 @with_logging()
 def send_confirmation_emails():
     regex = request.args.get('query')
-    count = int(request.args.get('count'))
-    query = {"isSecondConfirmationMailSent": {"$ne": True}}
-    if regex:
-        query.update({"email": {"$regex": regex}})
-    users = get_db().users.find(query, {"email": 1, "name": 1, "key": 1})
-    if count:
-        users = users.limit(count)
-    users_done = []
-    for user in users:
-        email = user['email']
-        MailMessageCreator.second_confirmation_email(email, user['name'], user['key']).send(to=email)
-        get_db().users.update({"email": email}, {"$set": {"isSecondConfirmationMailSent": True}})
-        users_done.append(email)
-    return success_response("Emails sent!", users=users_done)
+    count = int(request.args.get('count', 0))
+    campaign_id = campaign_runner.start(regex, count)
+    return success_response("Campaign started.", campaign=str(campaign_id)), 202
 
 
-if __name__ == '__main__':
+@app.route('/send_confirmation/<campaign_id>', methods=['GET'])
+@with_logging()
+def get_confirmation_campaign(campaign_id):
+    try:
+        campaign = get_db().campaigns.find_one({"_id": ObjectId(campaign_id)})
+    except InvalidId:
+        campaign = None
+    if campaign is None:
+        return error_response("Campaign %s not found" % campaign_id), 404
+    return success_response("Campaign %s." % campaign['status'], **campaign_status(campaign))
+
+
+@app.route('/ready', methods=['GET'])
+def get_readiness():
+    if not app_ready.is_set():
+        return error_response("Starting."), 503
+    try:
+        get_db().command('ping')
+    except PyMongoError as e:
+        return error_response("Database unavailable: %s" % e), 503
+    # mail is deferred while the Mailgun circuit is open, the app keeps serving requests
+    return success_response("Ready.", mailgun=mailgunresource.breaker.state)
+
+
+app_ready = threading.Event()
+
+
+def create_app():
+    # Runs once per deployment, in the master process when the app is preloaded by the WSGI server
+    get_mongo_client()
     with app.app_context():
+        indexes.ensure_indexes(get_db())
+        migrate_votes()
+        migrate_workshop_emails()
+        migrate_user_emails()
         load_workshops()
-    app.run(host="0.0.0.0", port=80)
+        send_welcome_emails()
+    app_ready.set()
+    return app
+
+
+def start_worker():
+    # Runs in every worker process, background threads of the master are not inherited by forked workers
+    with app.app_context():
+        campaign_runner.resume()
+    # also with the dispatcher backend the outbox holds messages deferred while the Mailgun circuit is open
+    if app.config['OUTBOX_WORKER_THREADS'] > 0:
+        outbox_worker.start()
+
+
+if __name__ == '__main__':
+    create_app()
+    start_worker()
+    app.run(host="0.0.0.0", port=int(os.environ.get('PORT', 80)), threaded=True)
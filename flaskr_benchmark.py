@@ -0,0 +1,200 @@
+import argparse
+import datetime
+import json
+import logging
+import random
+import subprocess
+import sys
+import time
+
+import mongomock
+
+import flaskr
+import mailgunresource
+import mailqueue
+from emails import EmailMessage, generate_email_id
+from mongomock_compat import install_mongomock_bulk_api
+
+SEED = 2014
+USERS = 5000
+WORKSHOPS = 200
+USERS_PER_WORKSHOP = 25
+EMAILS_PER_WORKSHOP = 5
+VOTES = 20000
+READERS = 50
+
+
+class FakeMailgunResponse():
+    status_code = 200
+    text = '{"message": "Queued. Thank you."}'
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+    def json(self):
+        return {"id": self.message_id, "message": "Queued. Thank you."}
+
+
+# Accepts every message like Mailgun would, after a fixed delay standing in for the network round trip
+class FakeMailgunClient():
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+
+    def send(self, **kwargs):
+        self.sent += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeMailgunResponse("<%d@fake.mailgun>" % self.sent)
+
+    def close(self):
+        pass
+
+
+def user_email(index):
+    return "user%d@example.com" % index
+
+
+def tag_id(index):
+    return "TAG%06d" % index
+
+
+def seed(db, rnd):
+    db.users.insert([{"email": user_email(i), "name": "User %d" % i, "key": "KEY%d" % i, "isConfirmed": True,
+                      "nfcTags": [tag_id(i)]} for i in range(USERS)])
+    for w in range(WORKSHOPS):
+        workshop_id = "workshop%d" % w
+        db.workshops.insert({"workshopId": workshop_id, "emailSecret": "secret%d" % w, "name": "Workshop %d" % w,
+                             "mentors": ["mentor%d@example.com" % w],
+                             "users": [user_email(i) for i in rnd.sample(range(USERS), USERS_PER_WORKSHOP)]})
+        for day in range(EMAILS_PER_WORKSHOP):
+            message = EmailMessage("Day %d" % day, "Workshop materials. " * 20, sender="mentor%d@example.com" % w,
+                                   date=datetime.datetime(2014, 9, day + 1), email_id=generate_email_id())
+            db.workshop_emails.insert(dict(message.as_db_dict(), workshopId=workshop_id))
+    now = datetime.datetime.utcnow()
+    votes = {}
+    for _ in range(VOTES):
+        mac, user = "MAC%02d" % rnd.randrange(READERS), rnd.randrange(USERS)
+        votes[(mac, user)] = {"mac": mac, "tagId": tag_id(user), "userEmail": user_email(user),
+                              "vote": rnd.choice([1, -1]), "timestamp": now.isoformat(), "date": now}
+    db.votes.insert(list(votes.values()))
+    db.vote_history.insert([dict(vote) for vote in votes.values()])
+
+
+def vote_request(rnd):
+    return json.dumps({"mac": "MAC%02d" % rnd.randrange(READERS), "tagId": tag_id(rnd.randrange(USERS)),
+                       "isPositive": rnd.random() < 0.7, "timestamp": "2014-09-18T10:32:59+00:00"})
+
+
+def scenarios(rnd):
+    return [
+        ('POST /users', 500, lambda i: ('post', '/users', {
+            'data': json.dumps({"email": "new%d@example.com" % i, "name": "New %d" % i})})),
+        ('POST /vote', 2000, lambda i: ('post', '/vote', {'data': vote_request(rnd)})),
+        ('POST /selldata', 1000, lambda i: ('post', '/selldata', {
+            'data': json.dumps({"mac": "MAC%02d" % rnd.randrange(READERS), "tagId": tag_id(rnd.randrange(USERS))})})),
+        ('GET /contact/<tag>', 2000, lambda i: ('get', '/contact/%s?requester=%d' % (
+            tag_id(rnd.randrange(USERS)), i), {})),
+        ('GET /contacts', 50, lambda i: ('get', '/contacts', {})),
+        ('POST /mailgun', 200, lambda i: ('post', '/mailgun', {'data': {
+            'from': 'Mentor <mentor@example.com>', 'subject': 'Update %d' % i, 'body-plain': 'text ' * 200,
+            'recipient': 'workshop-secret%d@system.warsjawa.pl' % rnd.randrange(WORKSHOPS)}})),
+        ('GET /emails/<id>', 1000, lambda i: ('get', '/emails/workshop%d' % rnd.randrange(WORKSHOPS), {})),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_scenario(client, requests, scale):
+    count = max(1, int(requests[1] * scale))
+    latencies, errors = [], 0
+    started_at = time.perf_counter()
+    for i in range(count):
+        method, path, kwargs = requests[2](i)
+        request_started_at = time.perf_counter()
+        response = getattr(client, method)(path, **kwargs)
+        response.get_data()  # consumes streamed responses
+        latencies.append(time.perf_counter() - request_started_at)
+        errors += response.status_code >= 500
+    mailqueue.dispatcher.flush()
+    elapsed = time.perf_counter() - started_at
+    latencies.sort()
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput": round(count / elapsed, 1),
+        "p50Ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99Ms": round(percentile(latencies, 0.99) * 1000, 3)
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(scale=1.0, mailgun_latency=0.0, only=None):
+    rnd = random.Random(SEED)
+    install_mongomock_bulk_api()
+    db = mongomock.Connection().db
+    seed(db, rnd)
+    flaskr.get_db = lambda: db
+    mailgunresource.client = FakeMailgunClient(mailgun_latency)
+    client = flaskr.app.test_client()
+    results = {}
+    for requests in scenarios(rnd):
+        if only is None or requests[0] in only:
+            results[requests[0]] = run_scenario(client, requests, scale)
+    return {"revision": revision(), "date": datetime.datetime.utcnow().isoformat(), "scale": scale,
+            "results": results}
+
+
+def report(run, baseline=None, out=sys.stdout):
+    out.write("%-20s %8s %8s %10s %10s %10s\n" % ("endpoint", "requests", "errors", "req/s", "p50 ms", "p99 ms"))
+    failed = False
+    for name, result in run['results'].items():
+        failed |= result['errors'] > 0
+        out.write("%-20s %8d %8d %10.1f %10.3f %10.3f%s\n" % (
+            name, result['requests'], result['errors'], result['throughput'], result['p50Ms'], result['p99Ms'],
+            error_mark(result)))
+        previous = (baseline or {}).get('results', {}).get(name)
+        if previous:
+            failed |= previous.get('errors', 0) > 0
+            out.write("%-20s %8s %8d %+9.1f%% %+9.1f%% %+9.1f%%%s\n" % (
+                "  vs %s" % baseline.get('revision'), "", previous.get('errors', 0),
+                change(previous['throughput'], result['throughput']),
+                change(previous['p50Ms'], result['p50Ms']),
+                change(previous['p99Ms'], result['p99Ms']), error_mark(previous)))
+    if failed:
+        out.write("! runs with failed requests (status >= 500), their latencies are not comparable\n")
+
+
+def error_mark(result):
+    return "  !" if result.get('errors', 0) > 0 else ""
+
+
+def change(before, after):
+    return (after - before) * 100.0 / before if before else 0.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks every endpoint against seeded mongomock data "
+                                                 "and a fake Mailgun")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies the number of requests per endpoint")
+    parser.add_argument('--mailgun-latency', type=float, default=0.0, help="seconds per fake Mailgun call")
+    parser.add_argument('--only', action='append', help="endpoint to run, e.g. 'POST /vote'")
+    parser.add_argument('--save', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON file with results of a previous run")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    run = benchmark(args.scale, args.mailgun_latency, args.only)
+    baseline = json.load(open(args.compare)) if args.compare else None
+    report(run, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(run, f, indent=2)
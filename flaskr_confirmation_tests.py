@@ -1,8 +1,14 @@
+import datetime
 import pprint
 import unittest
 from unittest.mock import patch
 
-from flaskr_tests import FlaskrWithMongoTest, user_in_db, EMAIL_ADDRESS as USER_EMAIL_ADDRESS, workshop_in_db
+from flask import json
+
+import flaskr
+import mailqueue
+from flaskr_tests import FlaskrWithMongoTest, user_in_db, EMAIL_ADDRESS as USER_EMAIL_ADDRESS, workshop_in_db, \
+    mailgun_post
 
 
 VALID_RESULT_ADDRESSES = ["user2@example.com", "user12@example.com", "user20@example.com", "user21@example.com",
@@ -19,7 +25,7 @@ class ConfirmationEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
 
     def test_should_return_user_workshops(self):
         self.db.users.insert(user_in_db(confirmed=True))
-        self.db.workshops.insert(workshop_in_db(with_user=True, with_mail=False))
+        self.db.workshops.insert(workshop_in_db(with_user=True))
 
         response = self.app.get('/confirmation/%s' % USER_EMAIL_ADDRESS)
 
@@ -39,6 +45,49 @@ class ConfirmationEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         for address in sent_email_addresses:
             self.assertIn(address, VALID_RESULT_ADDRESSES)
 
+    @patch('mailgunresource.requests')
+    def test_should_run_confirmation_campaign_in_background(self, requests_mock):
+        mailgun_post(requests_mock).return_value.status_code = 200
+        for i in range(23):
+            self.db.users.insert(user_in_db(confirmed=True, email="user%d@example.com" % i))
+
+        response = self.app.post('/send_confirmation?count=3&query=2')
+        flaskr.campaign_runner.wait(5)
+        mailqueue.dispatcher.flush()
+
+        self.assertEqual(response.status_code, 202)
+        campaign_id = json.loads(response.get_data(as_text=True))['campaign']
+        status = json.loads(self.app.get('/send_confirmation/%s' % campaign_id).get_data(as_text=True))
+        self.assertEqual(("done", 3, 0), (status['status'], status['sent'], status['failed']))
+        sent_to = [user['email'] for user in self.db.users.find({"isSecondConfirmationMailSent": True})]
+        self.assertEqual(3, len(sent_to))
+        for address in sent_to:
+            self.assertIn(address, VALID_RESULT_ADDRESSES)
+
+    @patch('mailgunresource.requests')
+    def test_should_resume_campaign_from_checkpoint(self, requests_mock):
+        mailgun_post(requests_mock).return_value.status_code = 200
+        user_ids = [self.db.users.insert(user_in_db(confirmed=True, email="user%d@example.com" % i))
+                    for i in range(5)]
+        now = datetime.datetime.utcnow()
+        campaign_id = self.db.campaigns.insert({
+            "kind": "second_confirmation", "regex": None, "count": 0, "status": "running",
+            "checkpoint": user_ids[2], "sent": 3, "failed": 0, "startedAt": now, "updatedAt": now,
+            "owner": "crashed", "leaseUntil": now - datetime.timedelta(seconds=1)
+        })
+
+        self.assertEqual([campaign_id], flaskr.campaign_runner.resume())
+        flaskr.campaign_runner.wait(5)
+
+        self.assertEqual(["user3@example.com", "user4@example.com"],
+                         sorted(user['email'] for user in self.db.users.find({"isSecondConfirmationMailSent": True})))
+        self.assertEqual(5, self.db.campaigns.find_one()['sent'])
+
+    def test_returns_404_if_campaign_not_found(self):
+        response = self.app.get('/send_confirmation/unknown')
+
+        self.assertEqual(response.status_code, 404)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pymongo.errors import ConnectionFailure
+
+import flaskr
+
+
+class MongoClientTest(unittest.TestCase):
+    def setUp(self):
+        flaskr._mongo_client = None
+
+    def tearDown(self):
+        flaskr._mongo_client = None
+
+    @patch('flaskr.MongoClient')
+    def test_should_share_one_client_between_requests(self, mongo_client_mock):
+        with flaskr.app.app_context():
+            first_db = flaskr.get_db()
+        with flaskr.app.app_context():
+            second_db = flaskr.get_db()
+
+        self.assertEqual(1, mongo_client_mock.call_count)
+        self.assertIs(first_db._database, second_db._database)
+
+    @patch('flaskr.MongoClient')
+    def test_should_configure_client_from_app_config(self, mongo_client_mock):
+        with flaskr.app.app_context():
+            flaskr.get_db()
+
+        ((host, port), options) = mongo_client_mock.call_args
+        self.assertEqual((flaskr.app.config['MONGO_HOST'], flaskr.app.config['MONGO_PORT']), (host, port))
+        self.assertEqual(flaskr.app.config['MONGO_MAX_POOL_SIZE'], options['max_pool_size'])
+        mongo_client_mock.return_value.__getitem__.assert_called_with(flaskr.app.config['MONGO_DB'])
+
+    @patch('flaskr.os.getpid')
+    @patch('flaskr.MongoClient')
+    def test_should_create_new_client_after_fork(self, mongo_client_mock, getpid_mock):
+        getpid_mock.return_value = 1
+        flaskr.get_mongo_client()
+
+        getpid_mock.return_value = 2
+        flaskr.get_mongo_client()
+
+        self.assertEqual(2, mongo_client_mock.call_count)
+
+
+class ReadinessTest(unittest.TestCase):
+    def setUp(self):
+        self.app = flaskr.app.test_client()
+        self.db = MagicMock()
+        self.original_get_db = flaskr.get_db
+        flaskr.get_db = lambda: self.db
+        flaskr.app_ready.set()
+
+    def tearDown(self):
+        flaskr.get_db = self.original_get_db
+        flaskr.app_ready.clear()
+
+    def test_should_be_ready_when_database_responds(self):
+        self.assertEqual(200, self.app.get('/ready').status_code)
+        self.db.command.assert_called_with('ping')
+
+    def test_should_not_be_ready_before_app_is_created(self):
+        flaskr.app_ready.clear()
+
+        self.assertEqual(503, self.app.get('/ready').status_code)
+
+    def test_should_not_be_ready_when_database_is_unavailable(self):
+        self.db.command.side_effect = ConnectionFailure("connection refused")
+
+        self.assertEqual(503, self.app.get('/ready').status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,18 @@
+import datetime
 import unittest
 import json
 from unittest.mock import patch
 
-from flaskr_tests import FlaskrWithMongoTest, assert_mailgun, EMAILS, FIRST_MAIL_SUBJECT, \
-    SECOND_MAIL_SUBJECT, WORKSHOP_ID, EXAMPLE_MAILGUN_POST, workshop_in_db, user_in_db, \
+from pymongo.errors import BulkWriteError
+
+import emails
+import flaskr
+import mailgunresource
+from emails import EmailMessage
+
+from flaskr_tests import FlaskrWithMongoTest, assert_mailgun, mailgun_post, EMAILS, FIRST_MAIL_SUBJECT, \
+    SECOND_MAIL_SUBJECT, WORKSHOP_ID, EXAMPLE_MAILGUN_POST, workshop_in_db, workshop_email_in_db, user_in_db, \
+    delivery_in_db, \
     EMAIL_ADDRESS as USER_EMAIL_ADDRESS
 
 
@@ -12,7 +21,8 @@ class EmailsEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
     @patch('mailgunresource.requests')
     def test_should_get_list_of_emails_for_specified_workshops(self, requests_mock):
         # Given a database with one workshop
-        self.db.workshops.insert(workshop_in_db(with_user=True, with_mail=True))
+        self.db.workshops.insert(workshop_in_db(with_user=True))
+        self.db.workshop_emails.insert(workshop_email_in_db())
 
         # When request
         rv = self.get_one_workshop()
@@ -21,6 +31,44 @@ class EmailsEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(json.loads(rv.data.decode('UTF-8')), EMAILS)
 
+    def test_should_reject_invalid_limit(self):
+        self.db.workshops.insert(workshop_in_db(with_user=True))
+
+        for limit in ["many", "0", "-1"]:
+            rv = self.app.get('/emails/%s?limit=%s' % (WORKSHOP_ID, limit))
+
+            self.assertEqual(400, rv.status_code)
+
+    def test_should_page_through_workshop_emails(self):
+        # Given a workshop with three emails
+        self.db.workshops.insert(workshop_in_db(with_user=True))
+        for day in range(1, 4):
+            message = EmailMessage("Day %d" % day, "text", date=datetime.datetime(2014, 9, day), email_id=day)
+            self.db.workshop_emails.insert(workshop_email_in_db(message))
+
+        # When
+        first_page = json.loads(self.app.get('/emails/%s?limit=2' % WORKSHOP_ID).data.decode('UTF-8'))
+        second_page = json.loads(self.app.get('/emails/%s?limit=2&cursor=%s' % (WORKSHOP_ID, first_page['next']))
+                                 .data.decode('UTF-8'))
+
+        # Then
+        self.assertEqual(["Day 1", "Day 2"], [email['subject'] for email in first_page['emails']])
+        self.assertEqual(["Day 3"], [email['subject'] for email in second_page['emails']])
+        self.assertNotIn('next', second_page)
+
+    def test_should_filter_workshop_emails_by_date(self):
+        # Given a workshop with two emails
+        self.db.workshops.insert(workshop_in_db(with_user=True))
+        for day in range(1, 3):
+            message = EmailMessage("Day %d" % day, "text", date=datetime.datetime(2014, 9, day), email_id=day)
+            self.db.workshop_emails.insert(workshop_email_in_db(message))
+
+        # When
+        rv = self.app.get('/emails/%s?since=2014-09-02' % WORKSHOP_ID)
+
+        # Then
+        self.assertEqual(["Day 2"], [email['subject'] for email in json.loads(rv.data.decode('UTF-8'))['emails']])
+
     @patch('mailgunresource.requests')
     def test_should_return_404_if_workshop_not_found(self, requests_mock):
         # Given an empty database
@@ -80,6 +128,7 @@ class EmailsEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
     @patch('mailgunresource.requests')
     def test_should_not_send_emails_already_sent_to_this_user(self, requests_mock):
         # Given:
+        mailgun_post(requests_mock).return_value.status_code = 200
         self.user_and_workshop_exists()
         self.user_selects_workshop()
         self.user_deselects_workshop()
@@ -89,10 +138,144 @@ class EmailsEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         self.user_selects_workshop()
 
         # Then
-        self.assertEqual(2, requests_mock.post.call_count)
+        self.assertEqual(2, mailgun_post(requests_mock).call_count)
         assert_mailgun(requests_mock, subject="Warsjawa - test_workshop: %s" % SECOND_MAIL_SUBJECT)
 
 
+    @patch('mailgunresource.requests')
+    def test_should_retry_deliveries_queued_long_ago(self, requests_mock):
+        # Given: forwarding the first email to the user was queued, but never reported
+        mailgun_post(requests_mock).return_value.status_code = 200
+        mailgun_post(requests_mock).return_value.json.return_value = {"id": "<message@system.warsjawa.pl>"}
+        self.user_and_workshop_exists(user=user_in_db(confirmed=True))
+        self.db.deliveries.insert(delivery_in_db(email_id=1, status="queued"))
+
+        # When:
+        self.user_selects_workshop()
+
+        # Then
+        self.assertEqual(1, mailgun_post(requests_mock).call_count)
+        self.assertEqual(["sent"], [delivery['status'] for delivery in self.db.deliveries.find()])
+
+    @patch('mailgunresource.requests')
+    def test_should_leave_failed_deliveries_to_replay(self, requests_mock):
+        # Given: forwarding the first email to the user failed, the failed call is in mail_errors
+        self.user_and_workshop_exists(user=user_in_db(confirmed=True))
+        self.db.deliveries.insert(delivery_in_db(email_id=1, status="failed"))
+
+        # When:
+        self.user_selects_workshop()
+
+        # Then
+        self.assertEqual(0, mailgun_post(requests_mock).call_count)
+
+    @patch('mailgunresource.requests')
+    def test_should_send_only_emails_user_has_not_received_yet(self, requests_mock):
+        # Given: user already received the first of two workshop emails
+        self.user_and_workshop_exists(user=user_in_db(confirmed=True))
+        self.db.deliveries.insert(delivery_in_db(email_id=1))
+        second_message = EmailMessage(SECOND_MAIL_SUBJECT, "text", date=datetime.datetime(2014, 9, 1), email_id=2)
+        self.db.workshop_emails.insert(workshop_email_in_db(second_message))
+
+        # When:
+        self.user_selects_workshop()
+
+        # Then
+        self.assertEqual(1, mailgun_post(requests_mock).call_count)
+        assert_mailgun(requests_mock, to=USER_EMAIL_ADDRESS, subject='Warsjawa - Workshop Name: %s' % SECOND_MAIL_SUBJECT)
+        self.assertEqual([1, 2], sorted(delivery['email_id'] for delivery in self.db.deliveries.find()))
+
+    @patch('mailgunresource.requests')
+    def test_should_record_delivery_status_and_mailgun_id(self, requests_mock):
+        # Given:
+        self.user_and_workshop_exists()
+        mailgun_post(requests_mock).return_value.status_code = 200
+        mailgun_post(requests_mock).return_value.json.return_value = {"id": "<message@system.warsjawa.pl>"}
+
+        # When:
+        self.user_selects_workshop()
+
+        # Then
+        delivery = self.db.deliveries.find_one({"email_id": 1, "recipient": USER_EMAIL_ADDRESS})
+        self.assertEqual("sent", delivery['status'])
+        self.assertEqual("<message@system.warsjawa.pl>", delivery['mailgunId'])
+        self.assertNotIn('emails', self.db.users.find_one())
+
+    @patch('mailgunresource.requests')
+    def test_should_store_emails_in_outbox_when_outbox_backend_is_used(self, requests_mock):
+        # Given:
+        self.user_and_workshop_exists()
+        self.addCleanup(emails.use_delivery_backend, emails.delivery_backend)
+        emails.use_delivery_backend(flaskr.outbox)
+
+        # When:
+        self.user_selects_workshop()
+
+        # Then
+        message = self.db.outbox.find_one()
+        self.assertEqual(([USER_EMAIL_ADDRESS], "pending"), (message['recipients'], message['status']))
+        self.assertEqual(["deliveries", {"email_id": 1}], list(message['report']))
+        self.assertEqual(0, mailgun_post(requests_mock).call_count)
+
+    @patch('mailgunresource.requests')
+    def test_should_defer_emails_to_outbox_while_mailgun_circuit_is_open(self, requests_mock):
+        # Given: recent Mailgun calls failed
+        self.user_and_workshop_exists()
+        self.addCleanup(mailgunresource.breaker.reset)
+        for _ in range(mailgunresource.breaker.min_calls):
+            mailgunresource.breaker.record(False)
+
+        # When:
+        self.user_selects_workshop()
+        flaskr.mailqueue.dispatcher.flush()
+
+        # Then
+        message = self.db.outbox.find_one()
+        self.assertEqual(([USER_EMAIL_ADDRESS], "pending"), (message['recipients'], message['status']))
+        self.assertEqual(0, mailgun_post(requests_mock).call_count)
+
+    @patch('flaskr.bulk_write')
+    def test_should_skip_emails_moved_by_crashed_migration(self, bulk_write_mock):
+        # Given: the unique email_id index rejected the email moved before the crash
+        bulk_write_mock.return_value = {'writeErrors': [{'index': 0, 'code': 11000}]}
+        self.db.workshops.insert(dict(workshop_in_db(with_user=True), emails=[workshop_email_in_db()]))
+
+        # When:
+        with flaskr.app.app_context():
+            flaskr.migrate_workshop_emails()
+
+        # Then
+        self.assertTrue(bulk_write_mock.call_args[1]['ignore_duplicates'])
+        self.assertNotIn('emails', self.db.workshops.find_one())
+
+    @patch('flaskr.bulk_write')
+    def test_should_keep_emails_in_workshop_when_migration_fails(self, bulk_write_mock):
+        # Given:
+        bulk_write_mock.side_effect = BulkWriteError({'writeErrors': [{'index': 0, 'code': 121}]})
+        self.db.workshops.insert(dict(workshop_in_db(with_user=True), emails=[workshop_email_in_db()]))
+
+        # When:
+        with flaskr.app.app_context():
+            flaskr.migrate_workshop_emails()
+
+        # Then
+        self.assertEqual(1, len(self.db.workshops.find_one()['emails']))
+
+    def test_should_report_deliveries_of_workshop_emails(self):
+        # Given: first email was delivered to two users and failed for one
+        self.db.workshops.insert(workshop_in_db(with_user=True))
+        self.db.workshop_emails.insert(workshop_email_in_db())
+        for recipient, status in [("a@example.com", "sent"), ("b@example.com", "sent"), ("c@example.com", "failed")]:
+            self.db.deliveries.insert(delivery_in_db(email_id=1, recipient=recipient, status=status))
+
+        # When:
+        rv = self.app.get('/emails/%s/deliveries' % WORKSHOP_ID)
+
+        # Then
+        deliveries = json.loads(rv.data.decode('UTF-8'))['deliveries']
+        self.assertEqual([(FIRST_MAIL_SUBJECT, 2, 1, 0)],
+                         [(d['subject'], d['sent'], d['failed'], d['queued']) for d in deliveries])
+
     @patch('mailgunresource.requests')
     def test_should_unregister_user_from_workshop(self, requests_mock):
         # Given:
@@ -106,9 +289,10 @@ class EmailsEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         workshop = self.db.workshops.find_one()
         self.assertNotIn(USER_EMAIL_ADDRESS, workshop['users'])
 
-    def user_and_workshop_exists(self, user=user_in_db(confirmed=True), workshop=workshop_in_db(with_user=False, with_mail=True)):
+    def user_and_workshop_exists(self, user=user_in_db(confirmed=True), workshop=workshop_in_db(with_user=False)):
         self.db.users.insert(user)
         self.db.workshops.insert(workshop)
+        self.db.workshop_emails.insert(workshop_email_in_db())
 
     def user_selects_workshop(self):
         return self.app.put('/emails/%s/%s' % (WORKSHOP_ID, USER_EMAIL_ADDRESS))
@@ -1,25 +1,43 @@
+import json
 import unittest
 from unittest.mock import patch
 
-from flaskr_tests import FlaskrWithMongoTest, assert_mailgun, EXAMPLE_MAILGUN_POST, SECOND_MAIL_SUBJECT, \
-    EMAIL_ADDRESS as USER_EMAIL_ADDRESS, workshop_in_db, user_in_db
+from flaskr_tests import FlaskrWithMongoTest, assert_mailgun, mailgun_post, EXAMPLE_MAILGUN_POST, SECOND_MAIL_SUBJECT, \
+    WORKSHOP_ID, EMAIL_ADDRESS as USER_EMAIL_ADDRESS, workshop_in_db, user_in_db
 
 
 class MailgunEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
     @patch('mailgunresource.requests')
     def test_should_save_incoming_emails_in_workshop_and_forward_to_users(self, requests_mock):
         # Given a database with one workshop
-        self.db.workshops.insert(workshop_in_db(with_user=True, with_mail=False))
+        self.db.workshops.insert(workshop_in_db(with_user=True))
         self.db.users.insert(user_in_db(confirmed=True))
 
         # When
         rv = self.mailgun_sends_email()
 
         # Then
-        self.assertEqual(1, len(self.db.workshops.find_one()['emails']))
-        self.assertEqual(1, requests_mock.post.call_count)
+        self.assertEqual(1, self.db.workshop_emails.find({"workshopId": WORKSHOP_ID}).count())
+        self.assertEqual(1, mailgun_post(requests_mock).call_count)
         assert_mailgun(requests_mock, to=USER_EMAIL_ADDRESS, subject='Warsjawa - test_workshop: %s' % SECOND_MAIL_SUBJECT)
 
+    @patch('mailgunresource.requests')
+    def test_should_forward_incoming_email_to_all_mentors_in_one_batch(self, requests_mock):
+        # Given a workshop with two mentors
+        workshop = workshop_in_db(with_user=False)
+        workshop['mentors'] = ["mentor1@example.com", "mentor2@example.com"]
+        self.db.workshops.insert(workshop)
+
+        # When
+        self.mailgun_sends_email()
+
+        # Then
+        self.assertEqual(1, mailgun_post(requests_mock).call_count)
+        assert_mailgun(requests_mock, to="mentor1@example.com, mentor2@example.com")
+        mailgun_data = mailgun_post(requests_mock).call_args[1]['data']
+        self.assertEqual({"mentor1@example.com": {}, "mentor2@example.com": {}},
+                         json.loads(mailgun_data['recipient-variables']))
+
     def mailgun_sends_email(self):
         rv = self.app.post('/mailgun', data=EXAMPLE_MAILGUN_POST)
         return rv
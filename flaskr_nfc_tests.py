@@ -1,9 +1,11 @@
+import time
 import unittest
+from unittest.mock import patch
 
 from flask import json
 
 from unittest.case import SkipTest
-from flaskr import find_user_for_tag
+from flaskr import app, find_user_for_tag, bump_tags_version, migrate_votes, tag_cache
 
 from flaskr_tests import FlaskrWithMongoTest, user_in_db, EMAIL_ADDRESS as USER_EMAIL_ADDRESS
 
@@ -36,6 +38,27 @@ class NfcEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.get_data(as_text=True), """[{"email": "jan@kowalski.com", "name": "Jan Brzęczyszczykiewicz"}]""")
 
+    def test_should_not_send_contacts_again_if_not_modified(self):
+        self.db.users.insert(user_in_db(confirmed=True))
+        etag = self.app.get('/contacts').headers['ETag']
+
+        response = self.app.get('/contacts', headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(as_text=True), "")
+
+    @patch('mailgunresource.requests')
+    def test_should_send_contacts_again_after_user_is_confirmed(self, requests_mock):
+        self.db.users.insert(user_in_db(confirmed=False))
+        etag = self.app.get('/contacts').headers['ETag']
+        self.app.put('/users', data='{"email": "%s", "key": "TEST_KEY"}' % USER_EMAIL_ADDRESS)
+
+        response = self.app.get('/contacts', headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(USER_EMAIL_ADDRESS, response.get_data(as_text=True))
+
     def test_returns_404_if_user_not_found(self):
         response = self.app.put('/contact/%s/%s' % (USER_EMAIL_ADDRESS, NFC_TAG_ID))
 
@@ -82,6 +105,51 @@ class NfcEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.status_code, 200)
 
+    def test_should_serve_repeated_tag_lookups_from_cache(self):
+        self.db.users.insert(user_in_db(confirmed=True, nfcTags=[NFC_TAG_ID]))
+        self.app.get('/contact/%s' % NFC_TAG_ID)
+        self.db.users.remove()
+
+        response = self.app.get('/contact/%s' % NFC_TAG_ID)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_should_not_query_mongo_for_warm_tag_lookups(self):
+        # Given:
+        self.db.users.insert(user_in_db(confirmed=True, nfcTags=[NFC_TAG_ID]))
+        self.app.get('/contact/%s' % NFC_TAG_ID)
+        self.db = None
+
+        # When:
+        user = find_user_for_tag(NFC_TAG_ID)
+
+        # Then
+        self.assertEqual(USER_EMAIL_ADDRESS, user['email'])
+
+    def test_should_find_new_tag_owner_after_tag_is_reassigned(self):
+        self.db.users.insert(user_in_db(confirmed=True, email="bob@example.com"))
+        self.db.users.insert(user_in_db(confirmed=True))
+        self.app.get('/contact/%s' % NFC_TAG_ID)
+        self.app.put('/contact/%s/%s' % ("bob@example.com", NFC_TAG_ID))
+        self.assertEqual(find_user_for_tag(NFC_TAG_ID)['email'], "bob@example.com")
+
+        self.app.put('/contact/%s/%s' % (USER_EMAIL_ADDRESS, NFC_TAG_ID))
+
+        self.assertEqual(find_user_for_tag(NFC_TAG_ID)['email'], USER_EMAIL_ADDRESS)
+
+    def test_should_find_new_tag_owner_after_tag_is_reassigned_by_another_process(self):
+        self.db.users.insert(user_in_db(confirmed=True, nfcTags=[NFC_TAG_ID]))
+        self.db.users.insert(user_in_db(confirmed=True, email="bob@example.com"))
+        self.app.get('/contact/%s' % NFC_TAG_ID)
+
+        self.db.users.update({"nfcTags": NFC_TAG_ID}, {"$pull": {"nfcTags": NFC_TAG_ID}})
+        self.db.users.update({"email": "bob@example.com"}, {"$addToSet": {"nfcTags": NFC_TAG_ID}})
+        bump_tags_version()
+
+        self.assertEqual(find_user_for_tag(NFC_TAG_ID)['email'], USER_EMAIL_ADDRESS)
+        with patch.object(tag_cache, 'clock', lambda: time.time() + app.config['TAG_CACHE_CHECK_SECONDS']):
+            self.assertEqual(find_user_for_tag(NFC_TAG_ID)['email'], "bob@example.com")
+
     def test_should_limit_finding_user_by_tag(self):
         self.db.users.insert(user_in_db(confirmed=True, nfcTags=[NFC_TAG_ID]))
         for i in range(50):
@@ -98,14 +166,12 @@ class NfcEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         self.assertEqual(response.status_code, 404)
 
     def test_should_register_new_votes(self):
-        raise SkipTest()
         response = self.app.post('/vote', data=VOTE_POSITIVE_REQUEST, content_type="application/json")
 
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.status_code, 201)
 
     def test_should_register_changed_votes(self):
-        raise SkipTest()
         first_response = self.app.post('/vote', data=VOTE_POSITIVE_REQUEST, content_type="application/json")
         self.assertEqual(first_response.status_code, 201)
 
@@ -124,6 +190,91 @@ class NfcEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         self.assertEqual(second_response.content_type, "application/json")
         self.assertEqual(second_response.status_code, 304)
 
+    def test_should_keep_only_current_vote_and_append_history(self):
+        self.app.post('/vote', data=VOTE_POSITIVE_REQUEST, content_type="application/json")
+        self.app.post('/vote', data=VOTE_NEGATIVE_REQUEST, content_type="application/json")
+
+        self.assertEqual(1, self.db.votes.count())
+        self.assertEqual(-1, self.db.votes.find_one()['vote'])
+        self.assertEqual([1, -1], [vote['vote'] for vote in self.db.vote_history.find()])
+
+    def test_should_summarize_votes_by_user_and_reader(self):
+        self.db.users.insert(user_in_db(confirmed=True, nfcTags=[NFC_TAG_ID]))
+        self.db.users.insert(user_in_db(confirmed=True, email="bob@example.com", nfcTags=["BOB_TAG"]))
+        bob_vote = json.loads(VOTE_POSITIVE_REQUEST)
+        bob_vote['tagId'] = "BOB_TAG"
+        votes = [json.loads(VOTE_POSITIVE_REQUEST), json.loads(VOTE_NEGATIVE_REQUEST), bob_vote]
+        self.app.post('/votes/batch', data=json.dumps(votes), content_type="application/json")
+        self.app.post('/vote', data=VOTE_POSITIVE_REQUEST, content_type="application/json")
+
+        response = self.app.get('/votes/summary')
+
+        summary = json.loads(response.get_data(as_text=True))
+        self.assertEqual([{"email": "bob@example.com", "score": 1, "votes": 1},
+                          {"email": USER_EMAIL_ADDRESS, "score": 1, "votes": 1}],
+                         sorted(summary['users'], key=lambda tally: tally['email']))
+        self.assertEqual([{"mac": "MAC", "score": 2, "votes": 2}], summary['readers'])
+
+    def test_should_reject_invalid_summary_limit(self):
+        for limit in ["ten", "0", "-1"]:
+            response = self.app.get('/votes/summary?limit=%s' % limit)
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_should_migrate_legacy_votes_once(self):
+        votes = [{"userEmail": USER_EMAIL_ADDRESS, "vote": 1, "timestamp": "2014-09-18T10:30:00+00:00"},
+                 {"userEmail": USER_EMAIL_ADDRESS, "vote": -1, "timestamp": "2014-09-18T10:32:59+00:00"}]
+        legacy_id = self.db.votes.insert({"mac": "MAC", "tagId": NFC_TAG_ID, "votes": votes})
+        # a crashed migration inserted the history before converting the document
+        self.db.vote_history.insert(dict(votes[0], mac="MAC", tagId=NFC_TAG_ID, _id="%s-0" % legacy_id))
+
+        migrate_votes()
+        migrate_votes()
+
+        self.assertEqual(2, self.db.vote_history.count())
+        self.assertEqual(-1, self.db.votes.find_one()['vote'])
+        tally = self.db.vote_tallies.find_one({"kind": "user"})
+        self.assertEqual((-1, 1), (tally['score'], tally['votes']))
+
+    def test_should_register_batch_of_votes(self):
+        self.db.users.insert(user_in_db(confirmed=True, nfcTags=[NFC_TAG_ID]))
+        votes = [json.loads(VOTE_POSITIVE_REQUEST), json.loads(VOTE_NEGATIVE_REQUEST), {"mac": "MAC"}]
+
+        response = self.app.post('/votes/batch', data=json.dumps(votes), content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        statuses = [vote['status'] for vote in json.loads(response.get_data(as_text=True))['votes']]
+        self.assertEqual([201, 200, 400], statuses)
+        stored_vote = self.db.votes.find_one({"mac": "MAC", "tagId": NFC_TAG_ID})
+        self.assertEqual(-1, stored_vote['vote'])
+        self.assertEqual(USER_EMAIL_ADDRESS, stored_vote['userEmail'])
+        self.assertEqual(2, self.db.vote_history.count())
+
+    def test_should_reject_votes_with_invalid_ids_in_batch(self):
+        self.db.users.insert(user_in_db(confirmed=True, nfcTags=[NFC_TAG_ID]))
+        votes = [json.loads(VOTE_POSITIVE_REQUEST), dict(json.loads(VOTE_POSITIVE_REQUEST), tagId=[NFC_TAG_ID]),
+                 dict(json.loads(VOTE_POSITIVE_REQUEST), mac={"id": "MAC"})]
+
+        response = self.app.post('/votes/batch', data=json.dumps(votes), content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        statuses = [vote['status'] for vote in json.loads(response.get_data(as_text=True))['votes']]
+        self.assertEqual([201, 400, 400], statuses)
+        self.assertEqual(1, self.db.votes.count())
+
+    def test_should_report_not_changed_votes_in_batch(self):
+        votes = json.dumps([json.loads(VOTE_POSITIVE_REQUEST)])
+        self.app.post('/votes/batch', data=votes, content_type="application/json")
+
+        response = self.app.post('/votes/batch', data=votes, content_type="application/json")
+
+        self.assertEqual([304], [vote['status'] for vote in json.loads(response.get_data(as_text=True))['votes']])
+
+    def test_should_reject_batch_which_is_not_a_list(self):
+        response = self.app.post('/votes/batch', data=VOTE_POSITIVE_REQUEST, content_type="application/json")
+
+        self.assertEqual(response.status_code, 400)
+
     def test_should_register_data_sellouts(self):
         response = self.app.post('/selldata', data=SELL_DATA_REQUEST, content_type="application/json")
 
@@ -3,10 +3,15 @@ import datetime
 import unittest
 
 import mongomock
+from flask.testing import FlaskClient
 from emails import EmailMessage
 
 import flaskr
+import mailgunresource
+import mailqueue
+from mongomock_compat import install_mongomock_bulk_api
 
+install_mongomock_bulk_api()
 
 NAME = "Jan Kowalski"
 EMAIL_ADDRESS = "jan@kowalski.com"
@@ -24,25 +29,32 @@ def user_in_db(confirmed=False, email=EMAIL_ADDRESS, **kwargs):
         "email": email,
         "name": NAME,
         "key": TEST_KEY,
-        "isConfirmed": confirmed,
-        "emails": []
+        "isConfirmed": confirmed
     }
     user.update(kwargs)
     return user
 
 
-def workshop_in_db(with_user, with_mail):
+def workshop_in_db(with_user):
     return {
         "workshopId": WORKSHOP_ID,
         "emailSecret": WORKSHOP_EMAIL_SECRET,
         "name": "Workshop Name",
         "mentors": [
         ],
-        "users": [EMAIL_ADDRESS] if with_user else [],
-        "emails": [EMAIL_MESSAGE] if with_mail else []
+        "users": [EMAIL_ADDRESS] if with_user else []
     }
 
 
+def workshop_email_in_db(email_message=EMAIL_MESSAGE):
+    return dict(email_message.as_db_dict(), workshopId=WORKSHOP_ID)
+
+
+def delivery_in_db(email_id, recipient=EMAIL_ADDRESS, status="sent"):
+    return {"email_id": email_id, "recipient": recipient, "status": status, "mailgunId": None,
+            "createdAt": CURRENT_DATE, "updatedAt": CURRENT_DATE}
+
+
 EMAILS = {"emails": [{"from": "source@example.com", "subject": FIRST_MAIL_SUBJECT, "text": "text",
                       "date": "Thu, 06 Dec 2007 16:29:43 GMT"}]}
 
@@ -61,18 +73,38 @@ EXAMPLE_MAILGUN_POST = {
 }
 
 
+class MailFlushingClient(FlaskClient):
+    def open(self, *args, **kwargs):
+        response = super().open(*args, **kwargs)
+        mailqueue.dispatcher.flush()
+        return response
+
+
 class FlaskrWithMongoTest():
     def setUp(self):
         def get_db():
             return self.db
 
+        mailgunresource.client.close()
+        flaskr.rate_limiter.reset()
+        flaskr.tag_cache.clear()
+        flaskr.workshop_registry.clear()
+        flaskr.app.test_client_class = MailFlushingClient
         self.app = flaskr.app.test_client()
         self.db = mongomock.Connection().db
+        self.original_get_db = flaskr.get_db
         flaskr.get_db = get_db
 
+    def tearDown(self):
+        flaskr.get_db = self.original_get_db
+
+
+def mailgun_post(requests_mock):
+    return requests_mock.Session.return_value.post
+
 
 def assert_mailgun(requests_mock, to=None, subject=None):
-    ((mailgun_url, ), mailgun_attrs) = requests_mock.post.call_args
+    ((mailgun_url, ), mailgun_attrs) = mailgun_post(requests_mock).call_args
     assert "https://api.mailgun.net/v2/system.warsjawa.pl/messages" == mailgun_url
     if to is not None:
         assert to == mailgun_attrs['data']['to']
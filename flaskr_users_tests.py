@@ -34,7 +34,7 @@ class UsersEndpointTest(FlaskrWithMongoTest, unittest.TestCase):
         self.assertEqual(self.db.users.find_one()["email"], EMAIL_ADDRESS)
         self.assertEqual(self.db.users.find_one()["name"], NAME)
         self.assertEqual(self.db.users.find_one()["isConfirmed"], False)
-        self.assertEqual(self.db.users.find_one()["emails"], [])
+        self.assertNotIn("emails", self.db.users.find_one())
         self.assertIsNotNone(self.db.users.find_one()["key"])
 
     @patch('mailgunresource.requests')
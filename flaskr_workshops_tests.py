@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import flaskr
+from flaskr_tests import FlaskrWithMongoTest, mailgun_post, workshop_in_db, WORKSHOP_ID
+
+WORKSHOPS_YML = """workshops:
+  - workshopId: %s
+    name: Workshop Name
+    mentors: [mentor@example.com]
+  - workshopId: new_workshop
+    name: New Workshop
+    mentors: [first@example.com, second@example.com]
+""" % WORKSHOP_ID
+
+
+class WorkshopsLoadingTest(FlaskrWithMongoTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        yaml_file, self.path = tempfile.mkstemp(suffix='.yml')
+        with os.fdopen(yaml_file, 'w') as f:
+            f.write(WORKSHOPS_YML)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super().tearDown()
+
+    def load_workshops(self):
+        with flaskr.app.app_context():
+            return flaskr.load_workshops(self.path)
+
+    def test_should_add_new_and_update_changed_workshops(self):
+        # Given: the first workshop exists without mentors
+        self.db.workshops.insert(workshop_in_db(with_user=True))
+
+        # When:
+        changes = self.load_workshops()
+
+        # Then
+        self.assertEqual({"added": ["new_workshop"], "updated": [WORKSHOP_ID], "unchanged": 0}, changes)
+        self.assertEqual(["mentor@example.com"], self.db.workshops.find_one({"workshopId": WORKSHOP_ID})['mentors'])
+        self.assertEqual(1, len(self.db.workshops.find_one({"workshopId": WORKSHOP_ID})['users']))
+        self.assertFalse(self.db.workshops.find_one({"workshopId": "new_workshop"})['welcomeEmailSent'])
+
+    def test_should_leave_unchanged_workshops_alone(self):
+        # Given:
+        self.load_workshops()
+        secret = self.db.workshops.find_one({"workshopId": "new_workshop"})['emailSecret']
+
+        # When:
+        changes = self.load_workshops()
+
+        # Then
+        self.assertEqual({"added": [], "updated": [], "unchanged": 2}, changes)
+        self.assertEqual(secret, self.db.workshops.find_one({"workshopId": "new_workshop"})['emailSecret'])
+
+    def test_should_refresh_workshop_registry_when_workshops_change(self):
+        # Given: the registry holds the workshop before it is renamed
+        self.db.workshops.insert(workshop_in_db(with_user=True))
+        with flaskr.app.app_context():
+            self.assertEqual([], flaskr.workshop_registry.get("workshopId", WORKSHOP_ID)['mentors'])
+
+        # When:
+        self.load_workshops()
+
+        # Then
+        with flaskr.app.app_context():
+            self.assertEqual(1, flaskr.get_workshops_version())
+            workshop = flaskr.workshop_registry.get("workshopId", WORKSHOP_ID)
+            self.assertEqual(["mentor@example.com"], workshop['mentors'])
+            self.assertEqual("new_workshop", flaskr.workshop_registry.get(
+                "emailSecret", self.db.workshops.find_one({"workshopId": "new_workshop"})['emailSecret'])['workshopId'])
+
+    @patch('mailgunresource.requests')
+    def test_should_queue_welcome_email_once_to_mentors_of_new_workshops(self, requests_mock):
+        # Given:
+        mailgun_post(requests_mock).return_value.status_code = 200
+        self.load_workshops()
+
+        # When:
+        with flaskr.app.app_context():
+            flaskr.send_welcome_emails()
+            flaskr.send_welcome_emails()
+
+        # Then: nothing is sent from the master process
+        self.assertEqual(0, mailgun_post(requests_mock).call_count)
+        self.assertEqual(2, self.db.outbox.find({"status": "pending"}).count())
+
+        # When: an outbox worker delivers them
+        with flaskr.app.app_context():
+            for message in self.db.outbox.find():
+                flaskr.deliver_from_outbox(message['recipients'], message['data'], tuple(message['report']),
+                                           message['priority'])
+
+        # Then
+        self.assertEqual(2, mailgun_post(requests_mock).call_count)
+        self.assertTrue(all(workshop['welcomeEmailSent'] for workshop in self.db.workshops.find()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# gunicorn -c gunicorn_config.py wsgi:application
+#
+# SIGHUP restarts workers gracefully. Preloaded code is not re-imported on SIGHUP, to deploy new code start
+# a new master with SIGUSR2 and stop the old one with SIGQUIT, or set WEB_PRELOAD=0.
+import multiprocessing
+import os
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+preload_app = os.environ.get('WEB_PRELOAD', '1') != '0'
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+accesslog = None
+
+
+def post_fork(server, worker):
+    import flaskr
+    flaskr.start_worker()
+
+
+def worker_exit(server, worker):
+    import flaskr
+    import mailqueue
+    flaskr.outbox_worker.stop(timeout=graceful_timeout)
+    if not mailqueue.dispatcher.shutdown(timeout=graceful_timeout):
+        server.log.error("Mail queue of worker %s was not drained before exit", worker.pid)
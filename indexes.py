@@ -0,0 +1,131 @@
+import datetime
+import logging
+import sys
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+
+logger = logging.getLogger('indexes')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+INDEXES = {
+    'users': [
+        ([('email', ASCENDING)], {'unique': True}),
+        ([('nfcTags', ASCENDING)], {}),
+        ([('isConfirmed', ASCENDING)], {}),
+    ],
+    'workshops': [
+        ([('workshopId', ASCENDING)], {'unique': True}),
+        ([('emailSecret', ASCENDING)], {'unique': True}),
+        ([('users', ASCENDING)], {}),
+    ],
+    'workshop_emails': [
+        ([('workshopId', ASCENDING), ('date', ASCENDING), ('_id', ASCENDING)], {}),
+        ([('email_id', ASCENDING)], {'unique': True}),
+    ],
+    'deliveries': [
+        ([('email_id', ASCENDING), ('recipient', ASCENDING)], {'unique': True}),
+    ],
+    'votes': [
+        ([('mac', ASCENDING), ('tagId', ASCENDING)], {'unique': True}),
+    ],
+    'vote_history': [
+        ([('mac', ASCENDING), ('tagId', ASCENDING), ('date', ASCENDING)], {}),
+    ],
+    'vote_tallies': [
+        ([('kind', ASCENDING), ('key', ASCENDING)], {'unique': True}),
+        ([('kind', ASCENDING), ('score', DESCENDING)], {}),
+    ],
+    'campaigns': [
+        ([('status', ASCENDING), ('leaseUntil', ASCENDING)], {}),
+    ],
+    'outbox': [
+        ([('status', ASCENDING), ('priority', ASCENDING), ('nextAttemptAt', ASCENDING)], {}),
+        ([('status', ASCENDING), ('leaseUntil', ASCENDING)], {}),
+        ([('claim', ASCENDING)], {}),
+        ([('sentAt', ASCENDING)], {'expireAfterSeconds': 7 * 24 * 3600}),
+    ],
+    'mail_errors': [
+        ([('resolved', ASCENDING), ('_id', ASCENDING)], {}),
+    ],
+    'invocations': [
+        ([('group', ASCENDING), ('source', ASCENDING), ('bucket', ASCENDING)], {}),
+        ([('expireAt', ASCENDING)], {'expireAfterSeconds': 0}),
+        # documents written before rate limit buckets were introduced
+        ([('timestamp', ASCENDING)], {'expireAfterSeconds': 24 * 3600}),
+    ],
+}
+
+# Representative query of every route, used to check that none of them scans a whole collection
+ROUTE_QUERIES = [
+    ('POST /users', 'users', {"email": "jan@kowalski.com"}),
+    ('PUT /users', 'users', {"email": "jan@kowalski.com", "key": "KEY"}),
+    ('PUT /emails/<workshop_id>/<attender_email>', 'workshops', {"workshopId": "workshop"}),
+    ('GET /emails/<workshop_id>', 'workshops', {"workshopId": "workshop"}),
+    ('GET /emails/<workshop_id>', 'workshop_emails', {"workshopId": "workshop", "date": {"$gte": EPOCH}}),
+    ('POST /mailgun', 'workshops', {"emailSecret": "secret"}),
+    ('POST /mailgun', 'users', {"email": {"$in": ["jan@kowalski.com"]}}),
+    ('POST /mailgun', 'deliveries', {"email_id": {"$in": ["id"]}, "recipient": {"$in": ["jan@kowalski.com"]}}),
+    ('GET /emails/<workshop_id>/deliveries', 'deliveries', {"email_id": {"$in": ["id"]}}),
+    ('GET /contacts', 'users', {"isConfirmed": True}),
+    ('PUT /contact/<user_email>/<tag_id>', 'users', {"nfcTags": "TAG"}),
+    ('GET /contact/<tag_id>', 'users', {"nfcTags": "TAG"}),
+    ('GET /contact/<tag_id>', 'invocations', {"group": "contact", "source": "x", "bucket": {"$gt": 0}}),
+    ('POST /vote', 'votes', {"mac": "MAC", "tagId": "TAG"}),
+    ('POST /vote', 'vote_tallies', {"kind": "user", "key": "jan@kowalski.com"}),
+    ('GET /votes/summary', 'vote_tallies', {"kind": "user"}),
+    ('GET /confirmation/<user_email>', 'workshops', {"users": "jan@kowalski.com"}),
+]
+
+
+def ensure_indexes(db):
+    for collection_name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                db[collection_name].ensure_index(keys, **options)
+            except OperationFailure:
+                logger.exception("Unable to create index %s on %s", keys, collection_name)
+
+
+def missing_indexes(db):
+    missing = []
+    for collection_name, indexes in INDEXES.items():
+        existing = [info['key'] for info in db[collection_name].index_information().values()]
+        missing.extend((collection_name, keys) for keys, options in indexes if keys not in existing)
+    return missing
+
+
+def winning_plan_uses_index(explain):
+    if 'cursor' in explain:  # MongoDB 2.x explain format
+        return not explain['cursor'].startswith('BasicCursor')
+    stages = []
+    plan = explain['queryPlanner']['winningPlan']
+    while plan is not None:
+        stages.append(plan['stage'])
+        plan = plan.get('inputStage')
+    return 'COLLSCAN' not in stages
+
+
+def explain_route_queries(db):
+    return [(route, collection_name, query, winning_plan_uses_index(db[collection_name].find(query).explain()))
+            for route, collection_name, query in ROUTE_QUERIES]
+
+
+def verify_indexes(db, out=sys.stdout):
+    ok = True
+    for collection_name, keys in missing_indexes(db):
+        out.write("MISSING  %s %s\n" % (collection_name, keys))
+        ok = False
+    for route, collection_name, query, uses_index in explain_route_queries(db):
+        out.write("%-8s %s: %s %s\n" % ("INDEX" if uses_index else "COLLSCAN", route, collection_name, query))
+        ok = ok and uses_index
+    return ok
+
+
+if __name__ == '__main__':
+    from flaskr import app, get_db
+
+    with app.app_context():
+        sys.exit(0 if verify_indexes(get_db()) else 1)
@@ -0,0 +1,50 @@
+import io
+import unittest
+from unittest.mock import MagicMock
+
+import indexes
+
+
+class IndexesTest(unittest.TestCase):
+    def test_should_create_all_declared_indexes(self):
+        db = MagicMock()
+
+        indexes.ensure_indexes(db)
+
+        db['users'].ensure_index.assert_any_call([('email', 1)], unique=True)
+        db['workshops'].ensure_index.assert_any_call([('emailSecret', 1)], unique=True)
+        db['votes'].ensure_index.assert_any_call([('mac', 1), ('tagId', 1)], unique=True)
+        db['workshop_emails'].ensure_index.assert_any_call([('email_id', 1)], unique=True)
+        db['invocations'].ensure_index.assert_any_call([('expireAt', 1)], expireAfterSeconds=0)
+
+    def test_should_report_missing_indexes(self):
+        db = MagicMock()
+        db['users'].index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            'email_1': {'key': [('email', 1)], 'unique': True}
+        }
+
+        missing = indexes.missing_indexes(db)
+
+        self.assertNotIn(('users', [('email', 1)]), missing)
+        self.assertIn(('users', [('nfcTags', 1)]), missing)
+
+    def test_should_detect_collection_scans_in_both_explain_formats(self):
+        self.assertFalse(indexes.winning_plan_uses_index({'cursor': 'BasicCursor'}))
+        self.assertTrue(indexes.winning_plan_uses_index({'cursor': 'BtreeCursor email_1'}))
+        self.assertFalse(indexes.winning_plan_uses_index({'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}))
+        self.assertTrue(indexes.winning_plan_uses_index(
+            {'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}}}))
+
+    def test_should_fail_verification_on_collection_scan(self):
+        db = MagicMock()
+        db.__getitem__.return_value.index_information.return_value = {}
+        db.__getitem__.return_value.find.return_value.explain.return_value = {'cursor': 'BasicCursor'}
+        out = io.StringIO()
+
+        self.assertFalse(indexes.verify_indexes(db, out))
+        self.assertIn("COLLSCAN GET /contacts", out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,27 @@
 import datetime
+import http.client as http_client
+import json
 import os
 import logging
-from flask import g
+import threading
+import time
+from contextlib import contextmanager
 
 import requests
 
+import mailqueue
+import metrics
+from circuitbreaker import CircuitBreaker, AdaptiveTimeout, OPEN, CLOSED, HALF_OPEN
+from ratelimit import TokenBucket
 
-logging.basicConfig()
-logging.getLogger().setLevel(logging.DEBUG)
-logger = logging.getLogger('mailgun')
-logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-logger.addHandler(ch)
-requests_log = logging.getLogger("requests.packages.urllib3")
-requests_log.setLevel(logging.DEBUG)
-requests_log.propagate = True
 
-import http.client as http_client
+logger = logging.getLogger('mailgun')
 
-http_client.HTTPConnection.debuglevel = 1
+MAILGUN_API_URL = "https://api.mailgun.net/v2/system.warsjawa.pl/messages"
+# Mailgun accepts at most 1000 recipients in a single batch message
+MAILGUN_BATCH_SIZE = min(int(os.environ.get('MAILGUN_BATCH_SIZE', 1000)), 1000)
+# Responses telling that Mailgun itself is failing or overloaded, other errors are caused by the message
+PROVIDER_FAILURES = {429} | set(range(500, 600))
 
 
 def send_deny_new_user(user_registration):
@@ -31,17 +32,172 @@ def send_deny_confirm_user(user_registration):
     logger.error('User %s, was trying to confirm again. But he was already confirmed.', user_registration['email'])
 
 
-def send_mail_raw(**kwargs):
-    mailgun_result = requests.post("https://api.mailgun.net/v2/system.warsjawa.pl/messages",
-                                   auth=("api", os.environ.get('MAILGUN_API_KEY')), **kwargs)
-    logger.debug("Mailgun %3d: %s, %s, %s", mailgun_result.status_code, kwargs, mailgun_result, mailgun_result.text)
-    if mailgun_result.status_code != 200 and hasattr(g, 'db'):
-        g.db.mail_errors.insert({
-            'request': kwargs,
+def enable_wire_debugging():
+    http_client.HTTPConnection.debuglevel = 1
+    requests_log = logging.getLogger("requests.packages.urllib3")
+    requests_log.setLevel(logging.DEBUG)
+    requests_log.propagate = True
+
+
+class MailgunClient():
+    # read_timeout is a number of seconds or an AdaptiveTimeout following the latency of recent calls
+    def __init__(self, api_key, url=MAILGUN_API_URL, pool_size=10, connect_timeout=3.05, read_timeout=10.0):
+        self.api_key = api_key
+        self.url = url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Connections must not be shared with a forked child process
+        if self._session is None or self._session_pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    session = requests.Session()
+                    session.auth = ("api", self.api_key)
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None and self._session_pid == os.getpid():
+                self._session.close()
+            self._session = None
+
+    def send(self, **kwargs):
+        if not isinstance(self.read_timeout, AdaptiveTimeout):
+            return self.session.post(self.url, timeout=(self.connect_timeout, self.read_timeout), **kwargs)
+        started_at = time.time()
+        result = self.session.post(self.url, timeout=(self.connect_timeout, self.read_timeout.current()), **kwargs)
+        self.read_timeout.observe(time.time() - started_at)
+        return result
+
+
+client = MailgunClient(
+    api_key=os.environ.get('MAILGUN_API_KEY'),
+    pool_size=int(os.environ.get('MAILGUN_POOL_SIZE', 10)),
+    connect_timeout=float(os.environ.get('MAILGUN_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=AdaptiveTimeout(minimum=float(os.environ.get('MAILGUN_MIN_READ_TIMEOUT', 2)),
+                                 maximum=float(os.environ.get('MAILGUN_READ_TIMEOUT', 10)))
+)
+
+if os.environ.get('MAILGUN_WIRE_DEBUG'):
+    enable_wire_debugging()
+
+
+mailgun_requests = metrics.registry.histogram('mailgun_request_duration_seconds', 'Duration of Mailgun API calls.',
+                                              labels=('status',))
+circuit_state = metrics.registry.gauge('circuit_breaker_state', 'State of a circuit breaker, 0 closed, 1 half-open, '
+                                                                '2 open.', labels=('circuit',))
+circuit_trips = metrics.registry.counter('circuit_breaker_trips_total', 'Times a circuit breaker opened.',
+                                         labels=('circuit',))
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def circuit_changed(circuit, state):
+    circuit_state.set(STATE_VALUES[state], circuit.name)
+    if state == OPEN:
+        circuit_trips.inc(circuit.name)
+        logger.warning("Circuit %s opened for %s seconds, Mailgun calls are failing", circuit.name,
+                       circuit.open_seconds)
+    else:
+        logger.warning("Circuit %s is %s", circuit.name, state)
+
+
+# While open, send_mail_raw raises CircuitOpenError without calling Mailgun, callers defer their messages
+breaker = CircuitBreaker(
+    'mailgun',
+    failure_rate=float(os.environ.get('MAILGUN_BREAKER_FAILURE_RATE', 0.5)),
+    min_calls=int(os.environ.get('MAILGUN_BREAKER_MIN_CALLS', 10)),
+    window=int(os.environ.get('MAILGUN_BREAKER_WINDOW', 20)),
+    open_seconds=float(os.environ.get('MAILGUN_BREAKER_OPEN_SECONDS', 30)),
+    on_change=circuit_changed
+)
+circuit_state.set(STATE_VALUES[CLOSED], breaker.name)
+
+# Callable returning the collection failed Mailgun calls are recorded in, it is configured by the application
+error_collection = None
+_recording = threading.local()
+
+
+@contextmanager
+def errors_handled_by_caller():
+    # for callers retrying failed calls themselves, like the outbox and the mail_errors replay
+    _recording.disabled = True
+    try:
+        yield
+    finally:
+        _recording.disabled = False
+
+
+@contextmanager
+def reported_as(report):
+    # a recorded failed call keeps the report of its message, so that a replay can report the delivery
+    _recording.report = report
+    try:
+        yield
+    finally:
+        _recording.report = None
+
+
+def record_error(request, status_code, text):
+    if error_collection is None or getattr(_recording, 'disabled', False):
+        return
+    try:
+        error_collection().insert({
+            'request': request,
             'result': {
-                'status_code': mailgun_result.status_code,
-                'text': mailgun_result.text
+                'status_code': status_code,
+                'text': text
             },
-            'date': datetime.datetime.now()
+            'date': datetime.datetime.now(),
+            'report': getattr(_recording, 'report', None),
+            'resolved': False,
+            'attempts': 0
         })
+    except Exception:
+        logger.exception("Unable to record failed Mailgun call %s", request)
+
+
+# Messages per second allowed by our Mailgun plan, shared by every thread sending from this process. With several
+# worker processes the application replaces it with a bucket kept in Mongo when MAILGUN_RATE_LIMIT_BACKEND=mongo.
+send_limit = TokenBucket(rate=float(os.environ.get('MAILGUN_RATE_LIMIT', 0)),
+                         capacity=float(os.environ['MAILGUN_RATE_BURST']) if 'MAILGUN_RATE_BURST' in os.environ else None)
+
+
+def send_mail_raw(priority=mailqueue.BULK, messages=1, **kwargs):
+    breaker.before_call()
+    send_limit.acquire(messages, priority)
+    started_at = time.time()
+    try:
+        mailgun_result = client.send(**kwargs)
+    except Exception as e:
+        breaker.record(False)
+        mailgun_requests.observe(time.time() - started_at, 'error')
+        record_error(kwargs, None, str(e))
+        raise
+    breaker.record(mailgun_result.status_code not in PROVIDER_FAILURES)
+    mailgun_requests.observe(time.time() - started_at, str(mailgun_result.status_code))
+    logger.debug("Mailgun %3d: %s, %s, %s", mailgun_result.status_code, kwargs, mailgun_result, mailgun_result.text)
+    if mailgun_result.status_code != 200:
+        record_error(kwargs, mailgun_result.status_code, mailgun_result.text)
     return mailgun_result
+
+
+def send_batch_raw(recipients, data, priority=mailqueue.BULK):
+    batch_data = dict(data)
+    batch_data['to'] = ', '.join(recipients)
+    # recipient-variables make Mailgun deliver a separate copy to every recipient
+    batch_data['recipient-variables'] = json.dumps({recipient: {} for recipient in recipients})
+    mailgun_result = send_mail_raw(priority, len(recipients), data=batch_data)
+    message_id = mailgun_result.json().get('id') if mailgun_result.status_code == 200 else None
+    results = {recipient: {'status_code': mailgun_result.status_code, 'id': message_id} for recipient in recipients}
+    logger.info("Mailgun batch %3d: %d recipients", mailgun_result.status_code, len(recipients))
+    return results
@@ -0,0 +1,88 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import mongomock
+
+import mailgunresource
+from mailgunresource import MailgunClient, MAILGUN_API_URL
+
+
+class MailgunClientTest(unittest.TestCase):
+    @patch('mailgunresource.requests')
+    def test_should_reuse_one_session_for_all_messages(self, requests_mock):
+        # Given
+        client = MailgunClient(api_key="key", pool_size=7, connect_timeout=2, read_timeout=3)
+
+        # When
+        client.send(data={'to': "first@example.com"})
+        client.send(data={'to': "second@example.com"})
+
+        # Then
+        self.assertEqual(1, requests_mock.Session.call_count)
+        requests_mock.adapters.HTTPAdapter.assert_called_once_with(pool_connections=1, pool_maxsize=7)
+        session = requests_mock.Session.return_value
+        self.assertEqual(("api", "key"), session.auth)
+        self.assertEqual(2, session.post.call_count)
+        session.post.assert_called_with(MAILGUN_API_URL, timeout=(2, 3), data={'to': "second@example.com"})
+
+    @patch('mailgunresource.requests')
+    def test_should_open_new_session_after_close(self, requests_mock):
+        client = MailgunClient(api_key="key")
+        client.send(data={})
+
+        client.close()
+        client.send(data={})
+
+        requests_mock.Session.return_value.close.assert_called_once_with()
+        self.assertEqual(2, requests_mock.Session.call_count)
+
+
+class MailErrorsTest(unittest.TestCase):
+    def setUp(self):
+        self.mail_errors = mongomock.Connection().db.mail_errors
+        self.original_error_collection = mailgunresource.error_collection
+        mailgunresource.error_collection = lambda: self.mail_errors
+
+    def tearDown(self):
+        mailgunresource.error_collection = self.original_error_collection
+
+    @patch('mailgunresource.client')
+    def test_should_record_failed_calls_without_application_context(self, client_mock):
+        client_mock.send.return_value = MagicMock(status_code=503, text="Service Unavailable")
+
+        mailgunresource.send_mail_raw(data={'to': "jan@kowalski.com"})
+
+        error = self.mail_errors.find_one()
+        self.assertEqual({'data': {'to': "jan@kowalski.com"}}, error['request'])
+        self.assertEqual((503, False), (error['result']['status_code'], error['resolved']))
+
+    @patch('mailgunresource.client')
+    def test_should_record_report_of_failed_batch(self, client_mock):
+        client_mock.send.return_value = MagicMock(status_code=503, text="Service Unavailable")
+
+        with mailgunresource.reported_as(("deliveries", {"email_id": "1"})):
+            mailgunresource.send_batch_raw(["jan@kowalski.com"], {})
+
+        self.assertEqual(["deliveries", {"email_id": "1"}], list(self.mail_errors.find_one()['report']))
+
+    @patch('mailgunresource.client')
+    def test_should_record_connection_errors(self, client_mock):
+        client_mock.send.side_effect = IOError("connection refused")
+
+        with self.assertRaises(IOError):
+            mailgunresource.send_mail_raw(data={})
+
+        self.assertEqual("connection refused", self.mail_errors.find_one()['result']['text'])
+
+    @patch('mailgunresource.client')
+    def test_should_not_record_calls_retried_by_caller(self, client_mock):
+        client_mock.send.return_value = MagicMock(status_code=503)
+
+        with mailgunresource.errors_handled_by_caller():
+            mailgunresource.send_mail_raw(data={})
+
+        self.assertEqual(0, self.mail_errors.count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import metrics
+
+
+logger = logging.getLogger('mailqueue')
+
+
+TRANSACTIONAL = 0
+BULK = 1
+PRIORITY_NAMES = {TRANSACTIONAL: 'transactional', BULK: 'bulk'}
+
+# Guards resetting dispatchers in a new process, the lock of a dispatcher is replaced by the reset itself
+_reset_lock = threading.Lock()
+
+queue_wait = metrics.registry.histogram('mail_queue_wait_seconds', 'Time mail waits in the dispatcher queue.',
+                                        labels=('priority',))
+
+
+# Jobs are taken by priority: a queued transactional mail is always started before any queued bulk mail.
+# `class_limits` caps the number of jobs of a priority running at the same time, so bulk traffic cannot occupy
+# every worker thread while transactional mail is waiting.
+class MailDispatcher():
+    def __init__(self, workers=4, max_size=1000, enqueue_timeout=1.0, job_context=None, class_limits=None):
+        self.workers = workers
+        self.max_size = max_size
+        self.enqueue_timeout = enqueue_timeout
+        self.job_context = job_context
+        self.class_limits = class_limits or {}
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._changed = threading.Condition(self._lock)
+        self._queues = {priority: deque() for priority in sorted(PRIORITY_NAMES)}
+        self._running = {priority: 0 for priority in PRIORITY_NAMES}
+        self._queued = 0
+        self._stopping = False
+        self._threads = []
+        self._pending = 0
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            with _reset_lock:
+                if self._pid != os.getpid():
+                    # Threads do not survive fork(), so a forked worker process starts its own pool.
+                    self._reset()
+                    self._pid = os.getpid()
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='mail-dispatcher-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_with_priority(BULK, fn, *args, **kwargs)
+
+    def submit_with_priority(self, priority, fn, *args, **kwargs):
+        future = Future()
+        job = (future, fn, args, kwargs)
+        if self.workers <= 0:
+            self._run(job)
+            return future
+        self._ensure_started()
+        with self._lock:
+            self._pending += 1
+            queued = self._changed.wait_for(lambda: self._queued < self.max_size, self.enqueue_timeout)
+            if queued:
+                self._queues[priority].append((time.time(), job))
+                self._queued += 1
+                self._changed.notify_all()
+        if not queued:
+            logger.warning("Mail queue is full (%d messages), delivering in the calling thread", self.max_size)
+            self._run(job)
+            self._done()
+        return future
+
+    def flush(self, timeout=None):
+        if self._pid != os.getpid():
+            return True
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def shutdown(self, timeout=None):
+        if self._pid != os.getpid():
+            return True
+        flushed = self.flush(timeout)
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._stopping = True
+            self._changed.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+        with self._lock:
+            self._stopping = False
+        return flushed
+
+    def _next_priority(self):
+        for priority, jobs in self._queues.items():
+            if jobs and self._running[priority] < self.class_limits.get(priority, self.workers):
+                return priority
+        return None
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._changed.wait_for(lambda: self._next_priority() is not None or
+                                       (self._stopping and self._queued == 0))
+                priority = self._next_priority()
+                if priority is None:
+                    return
+                enqueued_at, job = self._queues[priority].popleft()
+                self._queued -= 1
+                self._running[priority] += 1
+                self._changed.notify_all()
+            queue_wait.observe(time.time() - enqueued_at, PRIORITY_NAMES[priority])
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    self._running[priority] -= 1
+                    self._changed.notify_all()
+                self._done()
+
+    def _run(self, job):
+        future, fn, args, kwargs = job
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            if self.job_context is None:
+                result = fn(*args, **kwargs)
+            else:
+                with self.job_context():
+                    result = fn(*args, **kwargs)
+        except Exception as e:
+            logger.exception("Error while delivering mail")
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _done(self):
+        with self._idle:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+
+dispatcher = MailDispatcher(
+    workers=int(os.environ.get('MAIL_DISPATCHER_WORKERS', 4)),
+    max_size=int(os.environ.get('MAIL_DISPATCHER_QUEUE_SIZE', 1000)),
+    class_limits={BULK: int(os.environ.get('MAIL_DISPATCHER_BULK_WORKERS', 2))}
+)
+
+
+@atexit.register
+def _drain_on_exit():
+    if not dispatcher.shutdown(timeout=float(os.environ.get('MAIL_DISPATCHER_DRAIN_TIMEOUT', 30))):
+        logger.error("Mail queue was not drained before exit")
@@ -0,0 +1,131 @@
+import threading
+import unittest
+
+from mailqueue import MailDispatcher, TRANSACTIONAL, BULK
+
+
+class MailDispatcherTest(unittest.TestCase):
+    def test_should_deliver_in_background_thread(self):
+        # Given
+        dispatcher = MailDispatcher(workers=2)
+        delivered_in = []
+
+        # When
+        dispatcher.submit(lambda: delivered_in.append(threading.current_thread()))
+        dispatcher.flush()
+
+        # Then
+        self.assertEqual(1, len(delivered_in))
+        self.assertIsNot(threading.current_thread(), delivered_in[0])
+        dispatcher.shutdown()
+
+    def test_should_return_before_delivery_and_wait_on_flush(self):
+        # Given
+        dispatcher = MailDispatcher(workers=1)
+        release = threading.Event()
+
+        # When
+        future = dispatcher.submit(lambda: release.wait(5) and "sent")
+
+        # Then
+        self.assertFalse(future.done())
+        self.assertFalse(dispatcher.flush(timeout=0.05))
+        release.set()
+        self.assertTrue(dispatcher.flush(timeout=5))
+        self.assertEqual("sent", future.result())
+        dispatcher.shutdown()
+
+    def test_should_deliver_in_calling_thread_when_queue_is_full(self):
+        # Given
+        dispatcher = MailDispatcher(workers=1, max_size=1, enqueue_timeout=0.01)
+        started, release = threading.Event(), threading.Event()
+        dispatcher.submit(lambda: started.set() or release.wait(5))
+        started.wait(5)
+        dispatcher.submit(release.wait, 5)
+
+        # When
+        future = dispatcher.submit(threading.current_thread)
+
+        # Then
+        self.assertIs(threading.current_thread(), future.result(timeout=0))
+        release.set()
+        dispatcher.shutdown()
+
+    def test_should_not_lose_mail_submitted_concurrently_to_new_dispatcher(self):
+        # Given
+        dispatcher = MailDispatcher(workers=2)
+        delivered = []
+        start = threading.Barrier(8)
+
+        def submit(index):
+            start.wait(5)
+            dispatcher.submit(delivered.append, index)
+
+        threads = [threading.Thread(target=submit, args=(index,)) for index in range(8)]
+
+        # When
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        # Then
+        self.assertTrue(dispatcher.flush(timeout=5))
+        self.assertEqual(list(range(8)), sorted(delivered))
+        self.assertEqual(2, len(dispatcher._threads))
+        dispatcher.shutdown()
+
+    def test_should_deliver_synchronously_without_workers(self):
+        dispatcher = MailDispatcher(workers=0)
+
+        future = dispatcher.submit(lambda: "sent")
+
+        self.assertEqual("sent", future.result(timeout=0))
+
+    def test_should_report_delivery_errors_on_future(self):
+        dispatcher = MailDispatcher(workers=1)
+
+        future = dispatcher.submit(lambda: 1 / 0)
+        dispatcher.flush()
+
+        self.assertIsInstance(future.exception(), ZeroDivisionError)
+        dispatcher.shutdown()
+
+    def test_should_start_queued_transactional_mail_before_bulk_mail(self):
+        # Given
+        dispatcher = MailDispatcher(workers=1)
+        started, release = threading.Event(), threading.Event()
+        dispatcher.submit(lambda: started.set() or release.wait(5))
+        started.wait(5)
+        delivered = []
+        dispatcher.submit_with_priority(BULK, delivered.append, "bulk")
+        dispatcher.submit_with_priority(TRANSACTIONAL, delivered.append, "transactional")
+
+        # When
+        release.set()
+        dispatcher.flush(timeout=5)
+
+        # Then
+        self.assertEqual(["transactional", "bulk"], delivered)
+        dispatcher.shutdown()
+
+    def test_should_keep_workers_free_for_transactional_mail(self):
+        # Given
+        dispatcher = MailDispatcher(workers=2, class_limits={BULK: 1})
+        started, release = threading.Event(), threading.Event()
+        dispatcher.submit_with_priority(BULK, lambda: started.set() or release.wait(5))
+        started.wait(5)
+        dispatcher.submit_with_priority(BULK, lambda: "bulk")
+
+        # When
+        future = dispatcher.submit_with_priority(TRANSACTIONAL, lambda: "transactional")
+
+        # Then
+        self.assertEqual("transactional", future.result(timeout=5))
+        release.set()
+        dispatcher.flush(timeout=5)
+        dispatcher.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+import bisect
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_app_context
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value)) for name, value in pairs)
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter():
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self, extra=()):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['%s%s %s' % (self.name, format_labels(self.labels, label_values, extra), format_value(value))
+                for label_values, value in values]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts, total = self._values.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def count(self, *label_values):
+        counts, total = self._values.get(label_values, ([0], 0.0))
+        return sum(counts)
+
+    def samples(self, extra=()):
+        with self._lock:
+            values = sorted((label_values, (list(counts), total)) for label_values, (counts, total) in self._values.items())
+        lines = []
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else format_value(bound)
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, label_values,
+                                                                          list(extra) + [('le', le)]), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, label_values, extra), repr(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, label_values, extra), cumulative))
+        return lines
+
+
+# Metrics are kept in the memory of the process serving the request, every worker process exposes its own.
+# `constant_labels` returns labels added to every sample when rendering, the default registry labels samples with
+# the pid of the worker so series of different workers are not mixed up and can be summed with `without (pid)`.
+class Registry():
+    def __init__(self, constant_labels=None):
+        self.constant_labels = constant_labels
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        extra = self.constant_labels() if self.constant_labels is not None else ()
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples(extra))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(constant_labels=lambda: [('pid', os.getpid())])
+
+mongo_operations = registry.histogram('mongo_operation_duration_seconds', 'Duration of MongoDB operations.',
+                                      labels=('collection', 'operation'))
+
+TIMED_OPERATIONS = {'find', 'find_one', 'find_and_modify', 'insert', 'update', 'remove', 'save', 'count',
+                    'aggregate', 'ensure_index'}
+BULK_OPERATIONS = {'initialize_ordered_bulk_op', 'initialize_unordered_bulk_op'}
+
+
+def record_mongo_operation(collection, operation, seconds):
+    mongo_operations.observe(seconds, collection, operation)
+    if has_app_context():
+        g.mongo_operations = g.get('mongo_operations', 0) + 1
+        g.mongo_seconds = g.get('mongo_seconds', 0.0) + seconds
+
+
+# Thin wrappers counting and timing every operation made through get_db(). `find` is timed from the call until
+# its cursor is exhausted or closed, so fetching the documents is part of the recorded duration.
+class InstrumentedDatabase():
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return InstrumentedCollection(self._database[name], name)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._database, name)
+        if name.startswith('_') or not hasattr(attribute, 'find_one'):
+            return attribute
+        return InstrumentedCollection(attribute, name)
+
+
+class InstrumentedCollection():
+    def __init__(self, collection, name):
+        self._collection = collection
+        self._name = name
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name in BULK_OPERATIONS:
+            return lambda *args, **kwargs: InstrumentedBulk(attribute(*args, **kwargs), self._name)
+        if name not in TIMED_OPERATIONS:
+            return attribute
+
+        def timed(*args, **kwargs):
+            started_at = time.time()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception:
+                record_mongo_operation(self._name, name, time.time() - started_at)
+                raise
+            if name == 'find':
+                return InstrumentedCursor(result, self._name, time.time() - started_at)
+            record_mongo_operation(self._name, name, time.time() - started_at)
+            return result
+
+        return timed
+
+
+# Sums the time spent creating the cursor and fetching its batches, recorded once the cursor is exhausted or
+# closed. A cursor dropped before that is not recorded, the garbage collector may run while another request is
+# served. Chained calls like sort() or limit() keep returning the wrapper.
+class InstrumentedCursor():
+    def __init__(self, cursor, collection, seconds):
+        self._cursor = cursor
+        self._collection = collection
+        self._seconds = seconds
+        self._recorded = False
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+        if not callable(attribute):
+            return attribute
+
+        def chained(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            return self if result is self._cursor else result
+
+        return chained
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started_at = time.time()
+        try:
+            document = next(self._cursor)
+        except StopIteration:
+            self._seconds += time.time() - started_at
+            self._record()
+            raise
+        self._seconds += time.time() - started_at
+        return document
+
+    def __getitem__(self, index):
+        result = self._cursor[index]
+        return self if result is self._cursor else result
+
+    def close(self):
+        self._cursor.close()
+        self._record()
+
+    def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            record_mongo_operation(self._collection, 'find', self._seconds)
+
+
+# Operations are only collected by the bulk builder, the whole bulk is recorded as one 'bulk' operation on execute()
+class InstrumentedBulk():
+    def __init__(self, bulk, collection):
+        self._bulk = bulk
+        self._collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self._bulk, name)
+
+    def execute(self, *args, **kwargs):
+        started_at = time.time()
+        try:
+            return self._bulk.execute(*args, **kwargs)
+        finally:
+            record_mongo_operation(self._collection, 'bulk', time.time() - started_at)
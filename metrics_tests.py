@@ -0,0 +1,129 @@
+import os
+import unittest
+from unittest.mock import patch
+
+import mongomock
+
+import flaskr
+from bulk import bulk_write, insert, update_one
+from mongomock_compat import install_mongomock_bulk_api
+from metrics import Registry, InstrumentedDatabase, mongo_operations
+
+
+install_mongomock_bulk_api()
+
+
+class RegistryTest(unittest.TestCase):
+    def test_should_render_counters_in_prometheus_text_format(self):
+        registry = Registry()
+        counter = registry.counter('http_responses_total', 'HTTP responses.', labels=('endpoint', 'status'))
+
+        counter.inc('add_new_vote', '201')
+        counter.inc('add_new_vote', '201')
+
+        self.assertEqual('# HELP http_responses_total HTTP responses.\n'
+                         '# TYPE http_responses_total counter\n'
+                         'http_responses_total{endpoint="add_new_vote",status="201"} 2\n', registry.render())
+
+    def test_should_render_cumulative_histogram_buckets(self):
+        registry = Registry()
+        histogram = registry.histogram('latency_seconds', 'Latency.', labels=('endpoint',), buckets=(0.1, 1))
+
+        histogram.observe(0.05, 'vote')
+        histogram.observe(0.5, 'vote')
+        histogram.observe(3, 'vote')
+
+        rendered = registry.render()
+        self.assertIn('latency_seconds_bucket{endpoint="vote",le="0.1"} 1\n', rendered)
+        self.assertIn('latency_seconds_bucket{endpoint="vote",le="1"} 2\n', rendered)
+        self.assertIn('latency_seconds_bucket{endpoint="vote",le="+Inf"} 3\n', rendered)
+        self.assertIn('latency_seconds_sum{endpoint="vote"} 3.55\n', rendered)
+        self.assertIn('latency_seconds_count{endpoint="vote"} 3\n', rendered)
+
+    def test_should_escape_label_values(self):
+        registry = Registry()
+        registry.counter('errors_total', 'Errors.', labels=('message',)).inc('say "hi"\n')
+
+        self.assertIn('errors_total{message="say \\"hi\\"\\n"} 1', registry.render())
+
+    def test_should_add_constant_labels_to_every_sample(self):
+        registry = Registry(constant_labels=lambda: [('pid', 42)])
+        registry.counter('jobs_total', 'Jobs.').inc()
+        registry.histogram('job_seconds', 'Job duration.', buckets=(1,)).observe(0.5)
+
+        rendered = registry.render()
+
+        self.assertIn('jobs_total{pid="42"} 1\n', rendered)
+        self.assertIn('job_seconds_bucket{pid="42",le="1"} 1\n', rendered)
+        self.assertIn('job_seconds_count{pid="42"} 1\n', rendered)
+
+
+class InstrumentedDatabaseTest(unittest.TestCase):
+    def test_should_time_operations_per_collection(self):
+        db = InstrumentedDatabase(mongomock.Connection().db)
+        inserts, finds = mongo_operations.count('users', 'insert'), mongo_operations.count('users', 'find_one')
+
+        db.users.insert({"email": "jan@kowalski.com"})
+        user = db['users'].find_one({"email": "jan@kowalski.com"})
+
+        self.assertEqual("jan@kowalski.com", user['email'])
+        self.assertEqual(inserts + 1, mongo_operations.count('users', 'insert'))
+        self.assertEqual(finds + 1, mongo_operations.count('users', 'find_one'))
+
+    def test_should_time_find_until_cursor_is_exhausted(self):
+        # Given:
+        db = InstrumentedDatabase(mongomock.Connection().db)
+        db.users.insert({"email": "jan@kowalski.com"})
+        db.users.insert({"email": "anna@nowak.com"})
+        finds, seconds = mongo_operations.count('users', 'find'), self.seconds('users', 'find')
+
+        # When:
+        with patch('metrics.time.time', side_effect=[0, 1, 1, 3, 3, 5, 5, 6]):
+            cursor = db.users.find({}).sort("email")
+            emails = [user['email'] for user in cursor]
+
+        # Then:
+        self.assertEqual(["anna@nowak.com", "jan@kowalski.com"], emails)
+        self.assertEqual(finds + 1, mongo_operations.count('users', 'find'))
+        self.assertEqual(seconds + 6, self.seconds('users', 'find'))
+
+    def test_should_not_record_abandoned_cursors(self):
+        db = InstrumentedDatabase(mongomock.Connection().db)
+        finds = mongo_operations.count('users', 'find')
+
+        cursor = db.users.find({})
+        del cursor
+
+        self.assertEqual(finds, mongo_operations.count('users', 'find'))
+
+    def test_should_time_bulk_writes_on_execute(self):
+        db = InstrumentedDatabase(mongomock.Connection().db)
+        bulks = mongo_operations.count('votes', 'bulk')
+
+        bulk_write(db.votes, [insert({"mac": "MAC"}), update_one({"mac": "MAC"}, {"$set": {"vote": 1}})])
+
+        self.assertEqual(bulks + 1, mongo_operations.count('votes', 'bulk'))
+        self.assertEqual(1, db.votes.find_one({"mac": "MAC"})['vote'])
+
+    def seconds(self, *label_values):
+        return mongo_operations._values.get(label_values, (None, 0.0))[1]
+
+
+class MetricsEndpointTest(unittest.TestCase):
+    def test_should_expose_route_latency(self):
+        app = flaskr.app.test_client()
+        app.post('/users', data='invalid')
+
+        rv = app.get('/metrics')
+
+        self.assertEqual(200, rv.status_code)
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        body = rv.data.decode('UTF-8')
+        self.assertIn('http_request_duration_seconds_count{endpoint="add_new_user",method="POST",pid="%d"}'
+                      % os.getpid(), body)
+        self.assertIn('http_responses_total{endpoint="add_new_user",method="POST",status="400",pid="%d"}'
+                      % os.getpid(), body)
+
+
+if __name__ == '__main__':
+    unittest.main()
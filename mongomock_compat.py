@@ -0,0 +1,59 @@
+import mongomock
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+# mongomock has no bulk API, tests and the benchmark get one applying the operations one at a time like the server does
+class MongomockBulkOperation():
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.operations = []
+
+    def insert(self, document):
+        self.operations.append(('insert', document))
+
+    def find(self, query):
+        return MongomockBulkSelector(self, query)
+
+    def execute(self):
+        result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'writeErrors': [], 'writeConcernErrors': []}
+        for index, operation in enumerate(self.operations):
+            if operation[0] == 'insert':
+                try:
+                    self.collection.insert(operation[1])
+                    result['nInserted'] += 1
+                except DuplicateKeyError as e:
+                    result['writeErrors'].append({'index': index, 'code': 11000, 'errmsg': str(e), 'op': operation[1]})
+                    if self.ordered:
+                        break
+            else:
+                kind, query, update, upsert = operation
+                update_result = self.collection.update(query, update, upsert=upsert, multi=(kind == 'update'))
+                if update_result.get('updatedExisting'):
+                    result['nMatched'] += update_result['n']
+                else:
+                    result['nUpserted'] += update_result['n']
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
+
+
+class MongomockBulkSelector():
+    def __init__(self, bulk, query, upsert=False):
+        self.bulk = bulk
+        self.query = query
+        self._upsert = upsert
+
+    def upsert(self):
+        return MongomockBulkSelector(self.bulk, self.query, upsert=True)
+
+    def update_one(self, update):
+        self.bulk.operations.append(('update_one', self.query, update, self._upsert))
+
+    def update(self, update):
+        self.bulk.operations.append(('update', self.query, update, self._upsert))
+
+
+def install_mongomock_bulk_api():
+    mongomock.Collection.initialize_unordered_bulk_op = lambda collection: MongomockBulkOperation(collection, False)
+    mongomock.Collection.initialize_ordered_bulk_op = lambda collection: MongomockBulkOperation(collection, True)
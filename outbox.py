@@ -0,0 +1,243 @@
+import datetime
+import logging
+import os
+import random
+import socket
+import threading
+import uuid
+from concurrent.futures import Future
+
+import mailqueue
+from circuitbreaker import CircuitOpenError
+
+
+logger = logging.getLogger('outbox')
+
+# more urgent messages (lower priority number) first
+CLAIM_ORDER = [("priority", 1), ("nextAttemptAt", 1)]
+
+
+def worker_name():
+    return "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def delivery_error(result):
+    # Returns None when Mailgun accepted the message, otherwise (error, permanent)
+    status_codes = [r['status_code'] for r in result.values()] if isinstance(result, dict) else [result.status_code]
+    failed = [code for code in status_codes if code != 200]
+    if not failed:
+        return None
+    permanent = all(400 <= code < 500 and code != 429 for code in failed)
+    return "Mailgun responded with %s" % failed[0], permanent
+
+
+# Messages appended to the `outbox` collection are delivered by OutboxWorkers running in any process on any
+# node. A worker claims a batch of due messages by setting a claim token on them and keeps a lease on the batch
+# while delivering it. Messages whose lease expired (their worker died) can be claimed again, so delivery is
+# at-least-once. Failed messages are retried with exponential backoff until they are dead-lettered.
+class Outbox():
+    def __init__(self, get_collection, batch_size=20, lease_seconds=60, max_attempts=8, backoff_seconds=30,
+                 max_backoff_seconds=3600, clock=datetime.datetime.utcnow, random=random.random):
+        self.get_collection = get_collection
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.clock = clock
+        self.random = random
+
+    def append(self, recipients, data, report=None, priority=mailqueue.BULK):
+        now = self.clock()
+        return self.get_collection().insert({
+            "recipients": recipients,
+            "data": data,
+            "report": report,
+            "priority": priority,
+            "status": "pending",
+            "attempts": 0,
+            "nextAttemptAt": now,
+            "owner": None,
+            "claim": None,
+            "leaseUntil": None,
+            "lastError": None,
+            "createdAt": now,
+            "updatedAt": now
+        })
+
+    # Same interface as the in-process mail dispatcher, the message is handed over once it is stored
+    def submit(self, recipients, data, report=None, priority=mailqueue.BULK):
+        future = Future()
+        future.set_result(self.append(recipients, data, report, priority))
+        return future
+
+    def claim(self, owner):
+        now = self.clock()
+        claimable = {"$or": [{"status": "pending", "nextAttemptAt": {"$lte": now}},
+                             {"status": "sending", "leaseUntil": {"$lt": now}}]}
+        message_ids = [message['_id'] for message in self.get_collection().find(claimable, {"_id": 1})
+                       .sort(CLAIM_ORDER).limit(self.batch_size)]
+        if not message_ids:
+            return None, []
+        claim = uuid.uuid4().hex
+        # the claimable condition is checked again by every single document update, so a message taken by
+        # another worker in the meantime is not claimed twice
+        self.get_collection().update(
+            dict(claimable, _id={"$in": message_ids}),
+            {"$set": {"status": "sending", "owner": owner, "claim": claim, "updatedAt": now,
+                      "leaseUntil": now + datetime.timedelta(seconds=self.lease_seconds)}},
+            multi=True
+        )
+        return claim, list(self.get_collection().find({"claim": claim}).sort(CLAIM_ORDER))
+
+    def heartbeat(self, claim):
+        # False once the lease expired and the messages left in the batch were claimed by another worker
+        now = self.clock()
+        return self.get_collection().update(
+            {"claim": claim, "status": "sending"},
+            {"$set": {"leaseUntil": now + datetime.timedelta(seconds=self.lease_seconds), "updatedAt": now}},
+            multi=True
+        )['n'] > 0
+
+    def backoff(self, attempts):
+        delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (attempts - 1))
+        return datetime.timedelta(seconds=delay * (0.5 + self.random() / 2))
+
+    def mark_sent(self, message):
+        now = self.clock()
+        self.get_collection().update(
+            {"_id": message['_id'], "claim": message['claim']},
+            {"$set": {"status": "sent", "sentAt": now, "updatedAt": now, "lastError": None, "claim": None},
+             "$inc": {"attempts": 1}}
+        )
+
+    def mark_failed(self, message, error, permanent=False):
+        now = self.clock()
+        attempts = message['attempts'] + 1
+        if permanent or attempts >= self.max_attempts:
+            update = {"status": "dead", "deadAt": now}
+            logger.error("Message %s dead-lettered after %d attempts: %s", message['_id'], attempts, error)
+        else:
+            update = {"status": "pending", "nextAttemptAt": now + self.backoff(attempts)}
+        update.update(lastError=error, updatedAt=now, owner=None, claim=None)
+        self.get_collection().update({"_id": message['_id'], "claim": message['claim']},
+                                     {"$set": update, "$inc": {"attempts": 1}})
+
+    def postpone(self, message, seconds):
+        # the message was not attempted, so it does not count towards max_attempts
+        now = self.clock()
+        self.get_collection().update(
+            {"_id": message['_id'], "claim": message['claim']},
+            {"$set": {"status": "pending", "nextAttemptAt": now + datetime.timedelta(seconds=seconds),
+                      "owner": None, "claim": None, "updatedAt": now}}
+        )
+
+    def counts(self):
+        counts = {"pending": 0, "sending": 0, "sent": 0, "dead": 0}
+        for status in counts:
+            counts[status] = self.get_collection().find({"status": status}).count()
+        return counts
+
+
+class OutboxWorker():
+    def __init__(self, outbox, deliver, context, threads=1, poll_seconds=5.0):
+        self.outbox = outbox
+        self.deliver = deliver
+        self.context = context
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self.owner = worker_name()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self.owner = worker_name()  # workers are started after fork, every process claims under its own name
+        self._stopped.clear()
+        for index in range(self.threads):
+            thread = threading.Thread(target=self._run, name='outbox-worker-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+
+    def wait(self):
+        while not self._stopped.wait(1):
+            pass
+
+    def _run(self):
+        with self.context():
+            while not self._stopped.is_set():
+                try:
+                    delivered = self.run_once()
+                except Exception:
+                    logger.exception("Outbox worker failed, retrying in %s seconds", self.poll_seconds)
+                    delivered = 0
+                if delivered == 0:
+                    self._stopped.wait(self.poll_seconds)
+
+    def run_once(self):
+        claim, messages = self.outbox.claim(self.owner)
+        if not messages:
+            return 0
+        # a single delivery may wait on the rate limit for longer than the lease, so it is also renewed meanwhile
+        lost, done = threading.Event(), threading.Event()
+        renewal = threading.Thread(target=self._renew, args=(claim, lost, done), name='outbox-heartbeat')
+        renewal.daemon = True
+        renewal.start()
+        try:
+            last_heartbeat = self.outbox.clock()
+            for index, message in enumerate(messages):
+                if (self.outbox.clock() - last_heartbeat).total_seconds() > self.outbox.lease_seconds / 3:
+                    if not self.outbox.heartbeat(claim):
+                        lost.set()
+                    last_heartbeat = self.outbox.clock()
+                if lost.is_set():
+                    logger.warning("Lease of claim %s expired, %d messages are left to the worker that took them over",
+                                   claim, len(messages) - index)
+                    return index
+                self._deliver(message)
+            return len(messages)
+        finally:
+            done.set()
+            renewal.join()
+
+    def _renew(self, claim, lost, done):
+        with self.context():
+            while not done.wait(self.outbox.lease_seconds / 3):
+                try:
+                    if not self.outbox.heartbeat(claim):
+                        lost.set()
+                        return
+                except Exception:
+                    logger.exception("Renewing the lease of claim %s failed", claim)
+
+    def _deliver(self, message):
+        try:
+            report = tuple(message['report']) if message['report'] else None
+            error = delivery_error(self.deliver(message['recipients'], message['data'], report,
+                                                message.get('priority', mailqueue.BULK)))
+        except CircuitOpenError as e:
+            self.outbox.postpone(message, e.retry_after)
+            return
+        except Exception as e:
+            logger.exception("Delivery of message %s failed", message['_id'])
+            error = (str(e), False)
+        if error is None:
+            self.outbox.mark_sent(message)
+        else:
+            self.outbox.mark_failed(message, *error)
+
+
+if __name__ == '__main__':
+    import signal
+    from flaskr import outbox_worker
+
+    # Dedicated delivery process, it can run next to the web workers on any node
+    signal.signal(signal.SIGTERM, lambda signum, frame: outbox_worker.stop())
+    outbox_worker.start()
+    outbox_worker.wait()
@@ -0,0 +1,145 @@
+import datetime
+import unittest
+from contextlib import contextmanager
+from unittest.mock import MagicMock
+
+import mongomock
+
+from circuitbreaker import CircuitOpenError
+from outbox import Outbox, OutboxWorker, delivery_error
+
+
+class Clock():
+    def __init__(self, now=datetime.datetime(2014, 9, 1)):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+@contextmanager
+def no_context():
+    yield
+
+
+def accepted(recipients, data, report=None, priority=1):
+    return {recipient: {'status_code': 200, 'id': 'id'} for recipient in recipients}
+
+
+def responded(status_code):
+    def deliver(recipients, data, report=None, priority=1):
+        return {recipient: {'status_code': status_code, 'id': None} for recipient in recipients}
+
+    return deliver
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.Connection().db
+        self.clock = Clock()
+        self.outbox = Outbox(lambda: self.db.outbox, batch_size=10, lease_seconds=60, max_attempts=3,
+                             backoff_seconds=30, clock=self.clock, random=lambda: 1.0)
+
+    def worker(self, deliver):
+        return OutboxWorker(self.outbox, deliver, no_context)
+
+    def test_should_deliver_appended_messages_and_report(self):
+        deliver = MagicMock(side_effect=accepted)
+        self.outbox.append(["jan@kowalski.com"], {"subject": "Hello"}, ("deliveries", {"email_id": "1"}), priority=0)
+
+        delivered = self.worker(deliver).run_once()
+
+        self.assertEqual(1, delivered)
+        deliver.assert_called_once_with(["jan@kowalski.com"], {"subject": "Hello"}, ("deliveries", {"email_id": "1"}), 0)
+        self.assertEqual("sent", self.db.outbox.find_one()['status'])
+        self.assertEqual(0, self.worker(deliver).run_once())
+
+    def test_should_not_claim_messages_leased_by_another_worker(self):
+        self.outbox.append(["jan@kowalski.com"], {})
+        self.outbox.claim("other worker")
+
+        self.assertEqual((None, []), self.outbox.claim("worker"))
+
+        self.clock.advance(61)
+        claim, messages = self.outbox.claim("worker")
+        self.assertEqual(1, len(messages))
+        self.assertEqual("worker", messages[0]['owner'])
+
+    def test_should_retry_failed_messages_with_exponential_backoff(self):
+        self.outbox.append(["jan@kowalski.com"], {})
+        worker = self.worker(responded(503))
+
+        worker.run_once()
+        message = self.db.outbox.find_one()
+        self.assertEqual(("pending", 1), (message['status'], message['attempts']))
+        self.assertEqual(self.clock.now + datetime.timedelta(seconds=30), message['nextAttemptAt'])
+        self.assertEqual(0, worker.run_once())
+
+        self.clock.advance(30)
+        worker.run_once()
+        self.assertEqual(self.clock.now + datetime.timedelta(seconds=60), self.db.outbox.find_one()['nextAttemptAt'])
+
+    def test_should_dead_letter_after_max_attempts(self):
+        self.outbox.append(["jan@kowalski.com"], {})
+        worker = self.worker(MagicMock(side_effect=IOError("connection refused")))
+
+        for _ in range(3):
+            worker.run_once()
+            self.clock.advance(3600)
+
+        message = self.db.outbox.find_one()
+        self.assertEqual(("dead", 3, "connection refused"), (message['status'], message['attempts'], message['lastError']))
+
+    def test_should_dead_letter_permanent_failures_immediately(self):
+        self.outbox.append(["not an email"], {})
+
+        self.worker(responded(400)).run_once()
+
+        self.assertEqual("dead", self.db.outbox.find_one()['status'])
+
+    def test_should_postpone_messages_without_attempt_while_circuit_is_open(self):
+        self.outbox.append(["jan@kowalski.com"], {})
+
+        self.worker(MagicMock(side_effect=CircuitOpenError("mailgun", 20))).run_once()
+
+        message = self.db.outbox.find_one()
+        self.assertEqual(("pending", 0, None), (message['status'], message['attempts'], message['claim']))
+        self.assertEqual(self.clock.now + datetime.timedelta(seconds=20), message['nextAttemptAt'])
+
+    def test_should_report_whether_heartbeat_still_owns_the_claim(self):
+        self.outbox.append(["jan@kowalski.com"], {})
+        claim, _ = self.outbox.claim("worker")
+
+        self.assertTrue(self.outbox.heartbeat(claim))
+        self.clock.advance(61)
+        self.outbox.claim("other worker")
+        self.assertFalse(self.outbox.heartbeat(claim))
+
+    def test_should_stop_delivering_batch_once_lease_is_lost(self):
+        # Given: the lease expires while the first message is delivered
+        clock = Clock()
+        outbox = MagicMock(lease_seconds=60, clock=clock)
+        outbox.claim.return_value = ("claim", [{"_id": 1}, {"_id": 2}])
+        outbox.heartbeat.return_value = False
+        worker = OutboxWorker(outbox, MagicMock(), no_context)
+        worker._deliver = MagicMock(side_effect=lambda message: clock.advance(61))
+
+        # When:
+        delivered = worker.run_once()
+
+        # Then
+        self.assertEqual(1, delivered)
+        worker._deliver.assert_called_once_with({"_id": 1})
+        outbox.heartbeat.assert_called_with("claim")
+
+    def test_should_classify_mailgun_responses(self):
+        self.assertIsNone(delivery_error(MagicMock(status_code=200)))
+        self.assertEqual(("Mailgun responded with 429", False), delivery_error(MagicMock(status_code=429)))
+        self.assertEqual(("Mailgun responded with 401", True), delivery_error({"a": {"status_code": 401}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from pymongo.errors import DuplicateKeyError
+
+
+# Sliding window counter kept in process memory. Hits in the window are estimated from the current window count
+# plus the previous window count weighted by the part of it that still overlaps the sliding window.
+class MemoryRateLimiter():
+    def __init__(self, window, max_keys=10000, clock=time.time):
+        self.window = window
+        self.max_keys = max_keys
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._counters = OrderedDict()
+
+    def hit(self, group, source):
+        now = self.clock()
+        current_window = int(now // self.window)
+        key = (group, source)
+        with self._lock:
+            window_index, current, previous = self._counters.pop(key, (current_window, 0, 0))
+            if window_index == current_window - 1:
+                current, previous = 0, current
+            elif window_index != current_window:
+                current, previous = 0, 0
+            current += 1
+            self._counters[key] = (current_window, current, previous)
+            self._evict(current_window)
+        elapsed = (now % self.window) / self.window
+        return current + previous * (1 - elapsed)
+
+    def _evict(self, current_window):
+        # Least recently hit keys come first, so stale ones are dropped before the size bound kicks in
+        while self._counters:
+            key, (window_index, _, _) = next(iter(self._counters.items()))
+            if window_index < current_window - 1 or len(self._counters) > self.max_keys:
+                del self._counters[key]
+            else:
+                break
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+# Bucketed counters shared by all processes. The window is split into `buckets` parts, each stored as one small
+# document that expires through a TTL index on `expireAt`.
+class MongoRateLimiter():
+    def __init__(self, collection, window, buckets=10, clock=time.time):
+        self.collection = collection
+        self.window = window
+        self.buckets = buckets
+        self.clock = clock
+
+    def hit(self, group, source):
+        bucket_size = self.window / self.buckets
+        bucket = int(self.clock() // bucket_size)
+        expire_at = datetime.datetime.utcfromtimestamp((bucket + self.buckets + 1) * bucket_size)
+        self.collection().update(
+            {"group": group, "source": source, "bucket": bucket},
+            {"$inc": {"count": 1}, "$set": {"expireAt": expire_at}},
+            upsert=True
+        )
+        counters = self.collection().find(
+            {"group": group, "source": source, "bucket": {"$gt": bucket - self.buckets}},
+            {"count": 1}
+        )
+        return sum(counter['count'] for counter in counters)
+
+    def reset(self):
+        self.collection().remove({"bucket": {"$exists": True}})
+
+
+# Limits the rate of an operation across the threads of one process. acquire() blocks until a token is
+# available, tokens are refilled at `rate` per second up to `capacity`. A rate of 0 means no limit.
+# Callers asking for more tokens than the capacity go once the bucket is full and leave it in debt, later callers
+# wait until the debt is repaid, so a batch is charged for every message in it.
+# Callers of a lower priority number go first: nobody takes a token while a more urgent caller is waiting.
+class TokenBucket():
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._waiting = defaultdict(int)
+
+    def acquire(self, tokens=1, priority=0):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._waiting[priority] += 1
+        try:
+            while True:
+                with self._lock:
+                    more_urgent = any(count for waiting_priority, count in self._waiting.items()
+                                      if waiting_priority < priority)
+                    wait = 1.0 / self.rate if more_urgent else self._take(tokens)
+                if wait <= 0:
+                    return
+                self.sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting[priority] -= 1
+
+    def _take(self, tokens):
+        # Called with the lock held, returns 0 once the tokens are taken, otherwise seconds to wait for them
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        needed = min(tokens, self.capacity)
+        if self._tokens < needed:
+            return (needed - self._tokens) / self.rate
+        self._tokens -= tokens
+        return 0
+
+
+# Token bucket shared by all processes on all nodes, kept as one document per `name` holding the time the bucket
+# is full again (GCRA). It is updated with compare-and-set, so concurrent callers never take the same tokens.
+# The clocks of the nodes are expected to be in sync. Threads of one process still go by priority.
+class MongoTokenBucket(TokenBucket):
+    def __init__(self, collection, name, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        super().__init__(rate, capacity, clock, sleep)
+        self.collection = collection
+        self.name = name
+
+    def _take(self, tokens):
+        while True:
+            state = self.collection().find_one({"_id": self.name}, {"fullAt": 1})
+            now = self.clock()
+            full_at = max(now, state['fullAt']) if state is not None else now
+            available = self.capacity - (full_at - now) * self.rate
+            needed = min(tokens, self.capacity)
+            if available < needed:
+                return (needed - available) / self.rate
+            update = {"fullAt": full_at + tokens / self.rate}
+            if state is None:
+                try:
+                    self.collection().insert(dict(update, _id=self.name))
+                    return 0
+                except DuplicateKeyError:
+                    continue
+            if self.collection().update({"_id": self.name, "fullAt": state['fullAt']},
+                                        {"$set": update})['updatedExisting']:
+                return 0
+
+    def reset(self):
+        self.collection().remove({"_id": self.name})
@@ -0,0 +1,174 @@
+import datetime
+import unittest
+
+import mongomock
+
+from ratelimit import MemoryRateLimiter, MongoRateLimiter, MongoTokenBucket, TokenBucket
+
+
+class Clock():
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryRateLimiterTest(unittest.TestCase):
+    def test_should_count_hits_per_group_and_source(self):
+        limiter = MemoryRateLimiter(window=60, clock=Clock())
+
+        limiter.hit("contact", "x")
+        limiter.hit("contact", "x")
+
+        self.assertEqual(3, limiter.hit("contact", "x"))
+        self.assertEqual(1, limiter.hit("contact", "y"))
+        self.assertEqual(1, limiter.hit("vote", "x"))
+
+    def test_should_weight_previous_window_by_overlap(self):
+        clock = Clock(now=0)
+        limiter = MemoryRateLimiter(window=60, clock=clock)
+        for i in range(10):
+            limiter.hit("contact", "x")
+
+        clock.now = 90
+
+        self.assertEqual(6, limiter.hit("contact", "x"))
+
+    def test_should_forget_hits_older_than_two_windows(self):
+        clock = Clock(now=0)
+        limiter = MemoryRateLimiter(window=60, clock=clock)
+        limiter.hit("contact", "x")
+
+        clock.now = 125
+
+        self.assertEqual(1, limiter.hit("contact", "x"))
+
+    def test_should_keep_number_of_tracked_sources_bounded(self):
+        limiter = MemoryRateLimiter(window=60, max_keys=3, clock=Clock())
+
+        for source in range(10):
+            limiter.hit("contact", source)
+
+        self.assertEqual(3, len(limiter._counters))
+        self.assertEqual([("contact", 7), ("contact", 8), ("contact", 9)], list(limiter._counters))
+
+
+class MongoRateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.Connection().db
+
+    def test_should_sum_buckets_inside_window(self):
+        clock = Clock(now=0)
+        limiter = MongoRateLimiter(lambda: self.db.invocations, window=60, buckets=6, clock=clock)
+        limiter.hit("contact", "x")
+        clock.now = 30
+        limiter.hit("contact", "x")
+
+        clock.now = 65
+
+        self.assertEqual(2, limiter.hit("contact", "x"))
+        self.assertEqual(3, self.db.invocations.find({"group": "contact", "source": "x"}).count())
+
+    def test_should_expire_buckets_after_window(self):
+        limiter = MongoRateLimiter(lambda: self.db.invocations, window=60, buckets=6, clock=Clock(now=0))
+
+        limiter.hit("contact", "x")
+
+        self.assertEqual(datetime.datetime(1970, 1, 1, 0, 1, 10), self.db.invocations.find_one()['expireAt'])
+
+
+def sleeping(clock, waits):
+    def sleep(seconds):
+        waits.append(round(seconds, 6))
+        clock.now += seconds
+
+    return sleep
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_should_wait_for_tokens_once_capacity_is_used(self):
+        clock = Clock(now=0)
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            clock.now += seconds
+
+        bucket = TokenBucket(rate=10, capacity=2, clock=clock, sleep=sleep)
+
+        for _ in range(4):
+            bucket.acquire()
+
+        self.assertEqual([0.1, 0.1], [round(wait, 6) for wait in waits])
+
+    def test_should_not_give_tokens_to_bulk_callers_while_urgent_ones_wait(self):
+        clock = Clock(now=0)
+
+        def sleep(seconds):
+            # the transactional caller took its token and left
+            clock.now += seconds
+            bucket._waiting[0] = 0
+
+        bucket = TokenBucket(rate=10, capacity=1, clock=clock, sleep=sleep)
+        bucket._waiting[0] = 1
+
+        bucket.acquire(priority=1)
+
+        self.assertEqual(0.1, round(clock.now, 6))
+
+    def test_should_charge_batches_larger_than_capacity_in_full(self):
+        clock, waits = Clock(now=0), []
+        bucket = TokenBucket(rate=10, capacity=2, clock=clock, sleep=sleeping(clock, waits))
+
+        bucket.acquire(5)
+        bucket.acquire(1)
+
+        self.assertEqual([0.4], waits)
+
+
+class MongoTokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.Connection().db
+
+    def bucket(self, clock, waits):
+        return MongoTokenBucket(lambda: self.db.token_buckets, 'mailgun', rate=10, capacity=2, clock=clock,
+                                sleep=sleeping(clock, waits))
+
+    def test_should_share_tokens_between_processes(self):
+        clock, waits = Clock(now=0), []
+        first, second = self.bucket(clock, waits), self.bucket(clock, waits)
+
+        first.acquire()
+        second.acquire()
+        first.acquire()
+        second.acquire(5)
+
+        self.assertEqual([0.1, 0.2], waits)
+        self.assertEqual(0.8, round(self.db.token_buckets.find_one({"_id": "mailgun"})['fullAt'], 6))
+
+    def test_should_retry_when_another_process_took_tokens_first(self):
+        # Given: another process takes tokens between the read and the update
+        clock, waits = Clock(now=0), []
+        bucket = self.bucket(clock, waits)
+        bucket.acquire()
+        collection = self.db.token_buckets
+        update = collection.update
+
+        def concurrent_update(query, document):
+            collection.update = update
+            update({"_id": "mailgun"}, {"$set": {"fullAt": 0.2}})
+            return update(query, document)
+
+        collection.update = concurrent_update
+
+        # When:
+        bucket.acquire()
+
+        # Then
+        self.assertEqual([0.1], waits)
+        self.assertEqual(0.3, round(collection.find_one({"_id": "mailgun"})['fullAt'], 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
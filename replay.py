@@ -0,0 +1,106 @@
+import argparse
+import datetime
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mailgunresource
+import mailqueue
+from ratelimit import TokenBucket
+
+
+# Resends failed Mailgun calls recorded in `mail_errors`. Entries are read in _id order, one batch at a time,
+# and resent by `concurrency` threads limited to `rate` calls per second. A resent entry is marked resolved,
+# one that keeps failing is left alone after `max_attempts` replays. Successfully resent entries carrying a report
+# are passed to `report` in the calling thread, e.g. to mark the deliveries of a workshop email as sent.
+def recipient_count(request):
+    to = request.get('data', {}).get('to')
+    return len(to.split(', ')) if to else 1
+
+
+class MailErrorReplay():
+    def __init__(self, collection, send=mailgunresource.send_mail_raw, batch_size=100, concurrency=8, rate=50,
+                 max_attempts=3, report=None, clock=datetime.datetime.now, sleep=time.sleep):
+        self.collection = collection
+        self.send = send
+        self.report = report
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.bucket = TokenBucket(rate, sleep=sleep)
+
+    def _replayable(self, after=None):
+        query = {"resolved": {"$ne": True},
+                 "$or": [{"attempts": {"$exists": False}}, {"attempts": {"$lt": self.max_attempts}}]}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        return query
+
+    def counts(self):
+        return {
+            "unresolved": self.collection.find({"resolved": {"$ne": True}}).count(),
+            "replayable": self.collection.find(self._replayable()).count(),
+            "resolved": self.collection.find({"resolved": True}).count()
+        }
+
+    def replay(self, dry_run=False, limit=None):
+        counts = {"matched": 0, "resent": 0, "failed": 0}
+        last_id = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while limit is None or counts['matched'] < limit:
+                batch_size = self.batch_size if limit is None else min(self.batch_size, limit - counts['matched'])
+                entries = list(self.collection.find(self._replayable(last_id),
+                                                    {"request": 1, "attempts": 1, "report": 1})
+                               .sort([("_id", 1)]).limit(batch_size))
+                if not entries:
+                    break
+                last_id = entries[-1]['_id']
+                counts['matched'] += len(entries)
+                if dry_run:
+                    continue
+                for entry, (error, result) in zip(entries, executor.map(self._resend, entries)):
+                    counts['resent' if error is None else 'failed'] += 1
+                    if error is None and self.report is not None and entry.get('report'):
+                        self.report(tuple(entry['report']), entry['request'], result)
+        return counts
+
+    def _resend(self, entry):
+        self.bucket.acquire()
+        try:
+            with mailgunresource.errors_handled_by_caller():
+                # the Mailgun rate limit is charged for every recipient of a resent batch
+                result = self.send(priority=mailqueue.BULK, messages=recipient_count(entry['request']),
+                                   **entry['request'])
+            error = None if result.status_code == 200 else "Mailgun responded with %s" % result.status_code
+        except Exception as e:
+            result, error = None, str(e)
+        now = self.clock()
+        if error is None:
+            update = {"$set": {"resolved": True, "resolvedAt": now}, "$inc": {"attempts": 1}}
+        else:
+            update = {"$set": {"lastError": error, "lastAttemptAt": now}, "$inc": {"attempts": 1}}
+        self.collection.update({"_id": entry['_id']}, update)
+        return error, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Resends failed Mailgun calls recorded in mail_errors")
+    parser.add_argument('--dry-run', action='store_true', help="only count entries that would be resent")
+    parser.add_argument('--limit', type=int, help="resend at most this many entries")
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=50, help="Mailgun calls per second, 0 for no limit")
+    parser.add_argument('--max-attempts', type=int, default=3, help="skip entries replayed this many times")
+    args = parser.parse_args()
+
+    from emails import report_replayed
+    from flaskr import app, get_mail_errors
+
+    replay = MailErrorReplay(get_mail_errors(), batch_size=args.batch_size, concurrency=args.concurrency,
+                             rate=args.rate, max_attempts=args.max_attempts, report=report_replayed)
+    with app.app_context():
+        sys.stdout.write("Before: %s\n" % replay.counts())
+        sys.stdout.write("%s: %s\n" % ("Dry run" if args.dry_run else "Replayed",
+                                       replay.replay(args.dry_run, args.limit)))
+        sys.stdout.write("After: %s\n" % replay.counts())
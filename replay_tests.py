@@ -0,0 +1,84 @@
+import unittest
+from unittest.mock import MagicMock
+
+import mongomock
+
+from mailqueue import BULK
+from replay import MailErrorReplay
+
+
+def mail_error(to, status_code=503, **kwargs):
+    error = {"request": {"data": {"to": to}}, "result": {"status_code": status_code, "text": ""}, "resolved": False,
+             "attempts": 0}
+    error.update(kwargs)
+    return error
+
+
+class MailErrorReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.mail_errors = mongomock.Connection().db.mail_errors
+        self.send = MagicMock(return_value=MagicMock(status_code=200))
+
+    def replay(self, **kwargs):
+        return MailErrorReplay(self.mail_errors, send=self.send, batch_size=2, concurrency=2, rate=0, **kwargs)
+
+    def test_should_resend_unresolved_errors_in_batches_and_mark_them_resolved(self):
+        for index in range(5):
+            self.mail_errors.insert(mail_error("user%d@example.com" % index))
+        self.mail_errors.insert(mail_error("resolved@example.com", resolved=True))
+
+        counts = self.replay().replay()
+
+        self.assertEqual({"matched": 5, "resent": 5, "failed": 0}, counts)
+        self.assertEqual(5, self.send.call_count)
+        self.send.assert_any_call(priority=BULK, messages=1, data={"to": "user4@example.com"})
+        self.assertEqual({"unresolved": 0, "replayable": 0, "resolved": 6}, self.replay().counts())
+
+    def test_should_charge_rate_limit_for_every_recipient_of_resent_batch(self):
+        self.mail_errors.insert(mail_error("a@example.com, b@example.com, c@example.com"))
+
+        self.replay().replay()
+
+        self.send.assert_called_once_with(priority=BULK, messages=3, data={"to": "a@example.com, b@example.com, c@example.com"})
+
+    def test_should_only_count_entries_in_dry_run(self):
+        self.mail_errors.insert(mail_error("jan@kowalski.com"))
+        legacy_error = mail_error("legacy@example.com")
+        del legacy_error['attempts'], legacy_error['resolved']
+        self.mail_errors.insert(legacy_error)
+
+        counts = self.replay().replay(dry_run=True)
+
+        self.assertEqual({"matched": 2, "resent": 0, "failed": 0}, counts)
+        self.send.assert_not_called()
+
+    def test_should_keep_failing_entries_until_max_attempts(self):
+        self.mail_errors.insert(mail_error("jan@kowalski.com"))
+        self.send.return_value = MagicMock(status_code=500)
+
+        self.assertEqual({"matched": 1, "resent": 0, "failed": 1}, self.replay(max_attempts=2).replay())
+        self.replay(max_attempts=2).replay()
+
+        self.assertEqual({"matched": 0, "resent": 0, "failed": 0}, self.replay(max_attempts=2).replay())
+        error = self.mail_errors.find_one()
+        self.assertEqual((False, 2, "Mailgun responded with 500"), (error['resolved'], error['attempts'], error['lastError']))
+
+    def test_should_stop_at_limit(self):
+        for index in range(3):
+            self.mail_errors.insert(mail_error("user%d@example.com" % index))
+
+        self.assertEqual({"matched": 1, "resent": 1, "failed": 0}, self.replay().replay(limit=1))
+
+    def test_should_report_resent_entries_with_report(self):
+        self.mail_errors.insert(mail_error("a@example.com, b@example.com", report=["deliveries", {"email_id": "1"}]))
+        self.mail_errors.insert(mail_error("c@example.com"))
+        report = MagicMock()
+
+        self.replay(report=report).replay()
+
+        report.assert_called_once_with(("deliveries", {"email_id": "1"}), {"data": {"to": "a@example.com, b@example.com"}},
+                                       self.send.return_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
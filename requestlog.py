@@ -0,0 +1,103 @@
+import json
+import logging
+import random
+import time
+
+from flask import request
+
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+FORM_MIMETYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+
+def parse_settings(value, convert=str):
+    # "accept_incoming_emails=0.1, add_new_vote=0.01" -> {"accept_incoming_emails": 0.1, "add_new_vote": 0.01}
+    settings = {}
+    for item in filter(None, (part.strip() for part in (value or "").split(","))):
+        name, setting = item.split("=", 1)
+        settings[name.strip()] = convert(setting.strip())
+    return settings
+
+
+def configure_logging(level, logger_levels=None):
+    root = logging.getLogger()
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name, logger_level in (logger_levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level.upper())
+
+
+def truncate(text, max_length):
+    if text is None or len(text) <= max_length:
+        return text
+    return "%s...<%d more>" % (text[:max_length], len(text) - max_length)
+
+
+# Logs one structured (JSON) line per request. Nothing is read or formatted unless the line is going to be
+# written: the logger must be enabled for INFO and the request must be sampled for its endpoint. Bodies are
+# added only when DEBUG is enabled, truncated and with sensitive fields redacted.
+class RequestLogger():
+    def __init__(self, logger, max_body=1000, redacted_fields=(), sample_rates=None, default_sample_rate=1.0,
+                 random=random.random):
+        self.logger = logger
+        self.max_body = max_body
+        self.redacted_fields = set(redacted_fields)
+        self.sample_rates = sample_rates or {}
+        self.default_sample_rate = default_sample_rate
+        self.random = random
+
+    def sampled(self, endpoint):
+        rate = self.sample_rates.get(endpoint, self.default_sample_rate)
+        return rate >= 1 or (rate > 0 and self.random() < rate)
+
+    def redact(self, value):
+        if isinstance(value, dict):
+            return {k: "<redacted>" if k in self.redacted_fields else self.redact(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.redact(v) for v in value]
+        if isinstance(value, str):
+            return truncate(value, self.max_body)
+        return value
+
+    def request_body(self):
+        if request.mimetype in FORM_MIMETYPES:
+            body = self.redact(request.form.to_dict())
+            if request.files:
+                body['files'] = [f.filename for f in request.files.values()]
+            return body
+        data = request.get_data(cache=True, as_text=True)
+        try:
+            return self.redact(json.loads(data)) if data else None
+        except ValueError:
+            return truncate(data, self.max_body)
+
+    def response_body(self, response):
+        if response.is_streamed:
+            return "<streamed>"
+        data = response.get_data(as_text=True)
+        try:
+            return self.redact(json.loads(data)) if data else None
+        except ValueError:
+            return truncate(data, self.max_body)
+
+    def log(self, response, started_at, **fields):
+        failed = response.status_code >= 500
+        level = logging.WARNING if failed else logging.INFO
+        # server errors are always logged, regardless of sampling
+        if not self.logger.isEnabledFor(level) or not (failed or self.sampled(request.endpoint)):
+            return
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+            "durationMs": round((time.time() - started_at) * 1000, 1)
+        }
+        record.update(fields)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            record["request"] = self.request_body()
+            record["response"] = self.response_body(response)
+        self.logger.log(level, json.dumps(record, default=str, ensure_ascii=False))
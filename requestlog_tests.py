@@ -0,0 +1,78 @@
+import json
+import logging
+import unittest
+from unittest.mock import MagicMock
+
+from flask import Flask, Response, request
+
+from requestlog import RequestLogger, parse_settings
+
+
+app = Flask(__name__)
+
+
+def request_logger(level, **kwargs):
+    logger = MagicMock()
+    logger.isEnabledFor.side_effect = lambda checked_level: checked_level >= level
+    return RequestLogger(logger, **kwargs), logger
+
+
+def logged_record(logger):
+    ((level, message), _) = logger.log.call_args
+    return level, json.loads(message)
+
+
+class RequestLoggerTest(unittest.TestCase):
+    def test_should_parse_per_endpoint_settings(self):
+        self.assertEqual({"add_new_vote": 0.01, "accept_incoming_emails": 0.5},
+                         parse_settings("add_new_vote=0.01, accept_incoming_emails=0.5", float))
+        self.assertEqual({}, parse_settings(None))
+
+    def test_should_log_summary_without_bodies_at_info(self):
+        request_log, logger = request_logger(logging.INFO)
+        response = MagicMock(status_code=201)
+
+        with app.test_request_context('/users', method='POST', data='{"email": "jan@kowalski.com"}'):
+            request_log.log(response, 0)
+
+        level, record = logged_record(logger)
+        self.assertEqual(logging.INFO, level)
+        self.assertEqual(("POST", "/users", 201), (record['method'], record['path'], record['status']))
+        self.assertNotIn('request', record)
+        response.get_data.assert_not_called()
+
+    def test_should_not_format_anything_when_level_is_disabled(self):
+        request_log, logger = request_logger(logging.ERROR)
+        response = MagicMock(status_code=200)
+
+        with app.test_request_context('/users', method='POST', data='{}'):
+            request_log.log(response, 0)
+
+        logger.log.assert_not_called()
+        response.get_data.assert_not_called()
+
+    def test_should_skip_requests_not_sampled_for_endpoint(self):
+        request_log, logger = request_logger(logging.INFO, sample_rates={"vote": 0.1}, random=lambda: 0.5)
+
+        with app.test_request_context('/vote', method='POST'):
+            request.url_rule = MagicMock(endpoint="vote")
+            request_log.log(MagicMock(status_code=200), 0)
+            logger.log.assert_not_called()
+
+            request_log.log(MagicMock(status_code=500), 0)
+            self.assertEqual(logging.WARNING, logged_record(logger)[0])
+
+    def test_should_redact_and_truncate_bodies_at_debug(self):
+        request_log, logger = request_logger(logging.DEBUG, max_body=5, redacted_fields=["signature"])
+
+        with app.test_request_context('/mailgun', method='POST',
+                                      data={"signature": "secret", "body-plain": "long message"}):
+            request_log.log(Response('{"success": true}', 200), 0)
+
+        _, record = logged_record(logger)
+        self.assertEqual({"signature": "<redacted>", "body-plain": "long ...<7 more>"}, record['request'])
+        self.assertEqual({"success": True}, record['response'])
+
+
+if __name__ == '__main__':
+    unittest.main()